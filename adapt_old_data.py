@@ -1,5 +1,5 @@
 """Change old-style annotations to new-style annotations."""
-from vessel import *
+from vessel import Vessel
 
 from ipdb import set_trace as debug
 import re
@@ -1,8 +1,6 @@
-from database import *
-
 from glob import glob
 import re
-from vessel import *
+from vessel import Vessel
 
 
 if __name__ == "__main__":
@@ -1,27 +1,141 @@
 """Provide an API endpoint for the QuoteMachine."""
-from database import *
-from models import *
-from utils import *
-
-from bson import ObjectId
-from glob import glob
+from concurrency import enable_green_threads, offload
+
+enable_green_threads()  # before pymongo is imported, so Mongo I/O is cooperative
+
+from config import PROFILE_SLOW_MS
+from database import db
+from geo_utils import DIRECTIONS
+from map_pyramid import render_map_tile_png, seed_tile_cache
+import metrics
+from models import ImageModel, MapModel, create_machine_truth
+from package_cache import PackageCache, Prefetcher
+from previews import PREVIEW_LEVELS, get_preview
+from serialization import MIN_COMPRESS_BYTES, choose_encoding, compress, dumps
+from tile_cache import TileCache
+
+import hashlib
 import eventlet
 from eventlet import wsgi
-from flask import Flask, request, jsonify, Response, make_response, send_file
+from flask import Flask, request, Response, make_response, send_file
 from flask_restful import Resource, Api
 from flask_cors import CORS
-from ipdb import set_trace as debug
-import json
-import os
-from tqdm import tqdm
-from skimage.io import imread, imsave
-import io
+from functools import partial
+import threading
 
 
 PORT = 2005
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
+tile_cache = TileCache()
+package_cache = PackageCache()
+prefetcher = Prefetcher(package_cache)
+db.add_listener(package_cache.invalidate)  # truth/target writes drop stale packages
+seed_jobs = {}  # map_id -> status of the most recent tile seeding job
+
+
+@app.before_request
+def start_timing():
+    """Open a metrics record for this request."""
+    metrics.start_request()
+
+
+@app.after_request
+def finish_timing(response):
+    """Record the request's timings (registered first, so it runs last)."""
+    record = metrics.current()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    duration = metrics.finish_request(route, request.method, response.status_code)
+    if duration is not None:
+        timings = [
+            f"{stage};dur={seconds * 1000:.1f}"
+            for stage, (seconds, _) in record["stages"].items()
+        ]
+        timings.append(f"total;dur={duration * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """Serialize handler output with the fast JSON encoder."""
+    with metrics.timer("serialize"):
+        body = dumps(data)
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.mimetype = "application/json"
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON responses with br/gzip, as negotiated via Accept-Encoding."""
+    response.vary.add("Accept-Encoding")
+    if (
+        response.mimetype != "application/json"
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.status_code != 200
+        or response.content_length is None
+        or response.content_length < MIN_COMPRESS_BYTES
+    ):
+        return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is not None:
+        with metrics.timer("compress"):
+            response.set_data(compress(response.get_data(), encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:  # the encoded body is a different representation
+            response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def package_response(kind, resource_id, build):
+    """Serve a (cached) JSON package with an ETag; 304 if the client is current."""
+    entry = package_cache.get_or_build((kind, resource_id), build)
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    body = package_cache.encoded_body(entry, encoding)
+    response = Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    etag = entry["etag"]
+    if encoding is not None:  # compressed once per entry, not per request
+        response.headers["Content-Encoding"] = encoding
+        etag = f"{etag}-{encoding}"  # one ETag per representation
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def build_map_package(map_id):
+    """Build the package and footprint for a map."""
+    map_model = MapModel(db.get_map(map_id))
+    return map_model.package(), map_model.footprint()
+
+
+def build_image_package(image_id):
+    """Build the package and footprint for an image."""
+    image_model = ImageModel(db.get_image(image_id))
+    return image_model.package(), image_model.footprint()
+
+
+def prefetch_neighbors(image_id):
+    """Queue packages of the four neighbours of an image that was just served."""
+    image_dict = db.get_image(image_id)
+    for neighbor_id in image_dict.get("neighbors", {}).values():
+        if neighbor_id is not None:
+            prefetcher.submit(
+                ("image", neighbor_id), partial(build_image_package, neighbor_id)
+            )
+
+
+def image_response(data, mimetype="image/png", max_age=86400):
+    """Wrap image bytes in a response with ETag/Cache-Control (304 if unchanged)."""
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
 
 
 class Maps(Resource):
@@ -36,10 +150,53 @@ class Map(Resource):
     """Return all available site maps."""
 
     def get(self, map_id):
-        """Maps list is loaded when server boots up."""
-        tgt_map = db.get_map(map_id)
-        map_obj = MapModel(tgt_map)
-        return map_obj.package()
+        """Return the map with its ground truth (cached until truths change)."""
+        return package_response("map", map_id, lambda: build_map_package(map_id))
+
+
+class MapTile(Resource):
+    """Serve web-mercator (XYZ) tiles of a map, rendered on demand and cached."""
+
+    def get(self, map_id, z, x, y):
+        """Return the PNG tile, rendering it if it is not yet in the cache."""
+        data = tile_cache.get(map_id, z, x, y)
+        if data is None:
+            map_dict = db.get_map(map_id)
+            if map_dict is None:
+                return {"error": "No such map."}, 404
+            data = offload(render_map_tile_png, MapModel(map_dict), z, x, y)
+            if data is None:
+                return {"error": "Tile does not overlap the map."}, 404
+            tile_cache.put(map_id, z, x, y, data)
+        return image_response(data)
+
+
+class MapTileSeed(Resource):
+    """Pre-render the tiles of a map in the background."""
+
+    def get(self, map_id):
+        """Report progress of the latest seeding job for this map."""
+        return seed_jobs.get(map_id, {})
+
+    def post(self, map_id):
+        """Start seeding the tile cache for the specified zoom levels."""
+        data = request.json or {}
+        min_zoom = int(data.get("min_zoom", 14))
+        max_zoom = int(data.get("max_zoom", 20))
+        if map_id in seed_jobs and not seed_jobs[map_id].get("complete", True):
+            return seed_jobs[map_id], 409  # already running
+        map_dict = db.get_map(map_id)
+        if map_dict is None:
+            return {"error": "No such map."}, 404
+        map_model = MapModel(map_dict)
+        seed_jobs[map_id] = status = {"complete": False}
+        job = threading.Thread(
+            target=seed_tile_cache,
+            args=(map_model, tile_cache, min_zoom, max_zoom, status),
+            daemon=True,
+        )
+        job.start()
+        return status, 202
 
 
 class GroundTruths(Resource):
@@ -73,7 +230,7 @@ class Targets(Resource):
         """Add a new target."""
         target = request.json
         try:
-            db.targets.insert_one(target)
+            db.add_target(target)
         except:
             print("Sorry. Target already exists.")
         targets = db.get_targets()
@@ -92,8 +249,8 @@ class Target(Resource):
 
     def delete(self, target_id):
         """Delete the specified target."""
-        target_collection.delete_one({"scientific_name": target_id})
-        targets = list(target_collection.find({}, {"_id": 0}))
+        db.delete_target(target_id)
+        targets = db.get_targets()
         return targets, 200
 
 
@@ -115,9 +272,28 @@ class Image(Resource):
 
     def get(self, image_id):
         """Load the image and map associated ground truth."""
+        response = package_response(
+            "image", image_id, lambda: build_image_package(image_id)
+        )
+        prefetcher.pool.submit(prefetch_neighbors, image_id)
+        return response
+
+
+class ImagePreview(Resource):
+    """Serve a downscaled JPEG of a raw image (thumbnail, screen or full)."""
+
+    def get(self, image_id, level):
+        """Return the requested preview level, honouring conditional GETs."""
+        if level not in PREVIEW_LEVELS:
+            return {"error": f"Level must be one of {list(PREVIEW_LEVELS)}."}, 404
         image_dict = db.get_image(image_id)
-        image_model = ImageModel(image_dict)
-        return image_model.package()
+        if image_dict is None:
+            return {"error": "No such image."}, 404
+        path_to_preview = offload(get_preview, image_dict, level)
+        response = send_file(path_to_preview, mimetype="image/jpeg", conditional=True)
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+        return response
 
 
 class Navigate(Resource):
@@ -126,10 +302,60 @@ class Navigate(Resource):
     def get(self, image_id):
         """Return the neighboring image in the specified direction."""
         direction = request.args.get("direction")  # height
+        if direction not in DIRECTIONS:
+            return {"error": f"direction must be one of {', '.join(DIRECTIONS)}."}, 400
         image_dict = db.get_image(image_id)
-        image_model = ImageModel(image_dict)
-        neighbor_image = image_model.get_neighbor(direction)
-        return neighbor_image.package()
+        if image_dict is None:
+            return {"error": "No such image."}, 404
+        if "neighbors" in image_dict:  # precomputed; no need to build a model
+            neighbor_id = image_dict["neighbors"][direction]
+        else:
+            neighbor_image = ImageModel(image_dict).get_neighbor(direction)
+            neighbor_id = neighbor_image.image_id if neighbor_image else None
+        if neighbor_id is None:
+            return {"error": f"No image to the {direction} of this one."}, 404
+        response = package_response(
+            "image", neighbor_id, lambda: build_image_package(neighbor_id)
+        )
+        prefetcher.pool.submit(prefetch_neighbors, neighbor_id)
+        return response
+
+
+class CacheStats(Resource):
+    """Report package cache and prefetch hit rates."""
+
+    def get(self):
+        """Return the cache counters."""
+        return package_cache.summary()
+
+
+class Metrics(Resource):
+    """Expose request and stage timings to Prometheus."""
+
+    def get(self):
+        """Return all metrics in the Prometheus text format."""
+        return Response(
+            metrics.registry.exposition(),
+            mimetype="text/plain; version=0.0.4",
+        )
+
+
+class Profiler(Resource):
+    """Toggle the sampling profiler and list the slow requests it caught."""
+
+    def get(self):
+        """Return profiler settings and the folded stacks of slow requests."""
+        profiler = metrics.profiler
+        return {**profiler.settings(), "slow_requests": list(profiler.slow_requests)}
+
+    def post(self):
+        """Update settings, e.g. {"enabled": true, "threshold_ms": 500}."""
+        settings = request.get_json(force=True) or {}
+        return metrics.profiler.configure(
+            enabled=settings.get("enabled"),
+            threshold_ms=settings.get("threshold_ms"),
+            interval_ms=settings.get("interval_ms"),
+        )
 
 
 class ImageAnnotations(Resource):
@@ -146,6 +372,15 @@ class ImageAnnotations(Resource):
         return db.get_annotations_for_image(data["image_id"])
 
 
+class AnnotationBatch(Resource):
+    """Apply many annotation creates/deletes in one request."""
+
+    def post(self):
+        """Apply the operations; return per-item status and what changed."""
+        operations = request.json.get("operations", [])
+        return db.apply_annotation_operations(operations)
+
+
 class ImageAnnotation(Resource):
     """Returns annotations for a specific image."""
 
@@ -173,22 +408,36 @@ class Annotation(Resource):
 # Define endpoints.
 api.add_resource(Maps, "/maps", methods=["GET"], strict_slashes=False)
 api.add_resource(Map, "/maps/<map_id>", methods=["GET"])
+api.add_resource(
+    MapTile,
+    "/maps/<map_id>/tiles/<int:z>/<int:x>/<int:y>",
+    "/maps/<map_id>/tiles/<int:z>/<int:x>/<int:y>.png",
+    methods=["GET"],
+)
+api.add_resource(MapTileSeed, "/maps/<map_id>/tiles/seed", methods=["GET", "POST"])
 api.add_resource(Images, "/map-images/<map_id>/", methods=["GET"])
 api.add_resource(Image, "/images/<image_id>", methods=["GET"])
+api.add_resource(ImagePreview, "/images/<image_id>/preview/<level>", methods=["GET"])
 api.add_resource(Targets, "/targets", methods=["GET", "POST"])
 api.add_resource(Target, "/targets/<target_id>", methods=["GET", "PUT", "DELETE"])
 api.add_resource(ImageAnnotations, "/annotations", methods=["GET", "POST"])
+api.add_resource(AnnotationBatch, "/annotations/batch", methods=["POST"])
 api.add_resource(ImageAnnotation, "/annotations/<image_id>", methods=["GET", "DELETE"])
 api.add_resource(Annotation, "/annotation/<annotation_id>", methods=["DELETE"])
 api.add_resource(GroundTruths, "/truths", methods=["POST"])
 api.add_resource(GroundTruth, "/truths/<image_id>", methods=["DELETE"])
 api.add_resource(Navigate, "/images/navigate/<image_id>", methods=["GET"])
+api.add_resource(CacheStats, "/cache-stats", methods=["GET"])
+api.add_resource(Metrics, "/metrics", methods=["GET"])
+api.add_resource(Profiler, "/metrics/profiler", methods=["GET", "POST"])
 
 
 if __name__ == "__main__":
     from getpass import getuser
 
-    if getuser() == "mjl":
-        wsgi.server(eventlet.listen(("localhost", PORT)), app)
-    elif getuser() == "mlewis":  # we're on Zee
-        wsgi.server(eventlet.listen(("192.168.40.5", PORT)), app)
+    host = "localhost"
+    if getuser() == "mlewis":  # we're on Zee
+        host = "192.168.40.5"
+    if PROFILE_SLOW_MS:
+        metrics.profiler.configure(enabled=True, threshold_ms=float(PROFILE_SLOW_MS))
+    wsgi.server(eventlet.listen((host, PORT)), app)
@@ -0,0 +1,428 @@
+"""Asyncio-native variant of the ARGOS API, backed by the Motor MongoDB driver.
+
+Exposes the same routes as api.py. All database access is non-blocking; the
+CPU-heavy georeferencing (nearest-image search, ground truth projection) runs
+in a thread pool executor so the event loop keeps serving other annotators.
+A single process handles many concurrent clients without the memory cost of
+several WSGI workers.
+
+    > python async_api.py
+"""
+from config import DATABASE_NAME, MONGO_URI
+from database import plan_annotation_writes, summarize_annotation_writes
+from geo_utils import DIRECTIONS
+from models import (
+    ImageModel,
+    MapModel,
+    machine_truth_on_tile,
+    project_truths,
+)
+from serialization import MIN_COMPRESS_BYTES, dumps
+
+from aiohttp import web
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from motor.motor_asyncio import AsyncIOMotorClient
+import numpy as np
+import pymongo
+
+
+PORT = 2006
+NO_ID = {"_id": 0}
+
+
+def respond(data, status=200):
+    """Wrap data in a (compressed, if large and accepted) JSON response."""
+    body = dumps(data)
+    response = web.Response(body=body, status=status, content_type="application/json")
+    if len(body) >= MIN_COMPRESS_BYTES:
+        response.enable_compression()  # negotiated from Accept-Encoding
+    return response
+
+
+def build_ball_tree(locations):
+    """BallTree over (lat, lon) locations (executor); None if there are none."""
+    if len(locations) == 0:
+        return None
+    from sklearn.neighbors import BallTree  # sklearn is slow to import
+
+    return BallTree(locations)
+
+
+class TruthIndex:
+    """Ground truth, targets and a BallTree over truth positions for this process.
+
+    Writes update the in-memory truths directly and only mark the tree stale;
+    it is rebuilt once, by the next request that needs it.
+    """
+
+    def __init__(self, mdb):
+        """Hold on to the Motor database; data is loaded by load()."""
+        self.mdb = mdb
+        self.lock = asyncio.Lock()
+        self.truths = []  # sorted by datetime, as the tree is built from them
+        self.targets = []
+        self.indexed = ([], None)  # (truths, tree over them), swapped together
+        self.stale = False
+
+    async def load(self):
+        """Read all truths and targets from the database (at startup)."""
+        truths = await self.mdb.ground_truth.find({}, NO_ID).to_list(None)
+        self.truths = sorted(truths, key=lambda x: x["datetime"])
+        await self.load_targets()
+        self.stale = True
+        await self.ensure_tree()
+
+    async def load_targets(self):
+        """Re-read the targets (a small collection) after they change."""
+        self.targets = await self.mdb.targets.find({}, NO_ID).to_list(None)
+
+    def add_truth(self, truth):
+        """Record a truth just inserted into the database."""
+        truth = {k: v for k, v in truth.items() if k != "_id"}
+        # New truths are the latest, so this is an append in practice.
+        idx = len(self.truths)
+        while idx > 0 and self.truths[idx - 1]["datetime"] > truth["datetime"]:
+            idx -= 1
+        self.truths = self.truths[:idx] + [truth] + self.truths[idx:]
+        self.stale = True
+
+    def remove_truths(self, image_id):
+        """Drop the truths just deleted from the database for an image."""
+        self.truths = [t for t in self.truths if t.get("image_id") != image_id]
+        self.stale = True
+
+    async def ensure_tree(self):
+        """Rebuild the tree if truths changed since it was built."""
+        if not self.stale:
+            return
+        async with self.lock:
+            if not self.stale:  # rebuilt while we waited for the lock
+                return
+            truths = self.truths
+            self.stale = False
+            locations = np.array([t["latlon"] for t in truths]).reshape(-1, 2)
+            loop = asyncio.get_running_loop()
+            try:
+                tree = await loop.run_in_executor(None, build_ball_tree, locations)
+            except Exception:
+                self.stale = True
+                raise
+            self.indexed = (truths, tree)
+
+    def locate(self, model, to_alpha_beta, in_bounds):
+        """Nearby/unique truths for a model (runs in the executor)."""
+        (truths, tree), targets = self.indexed, self.targets
+        if tree is None:  # no ground truth yet
+            return [], []
+        lat, lon = model.to_lat_lon(0.5, 0.5)
+        _, ordered_truth = tree.query([[lat, lon]], k=min(300, len(truths)))
+        ordered_truth = ordered_truth[0]
+        # Projection annotates the truths, so hand it copies of the candidates.
+        candidates = [dict(truths[idx]) for idx in ordered_truth]
+        return project_truths(candidates, targets, to_alpha_beta, in_bounds)
+
+
+@web.middleware
+async def cors(request, handler):
+    """Allow cross-origin requests from the annotation client."""
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    return response
+
+
+async def run_cpu(request, func, *args):
+    """Run CPU-bound work on the app's executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app["executor"], partial(func, *args))
+
+
+async def get_annotations_for_image(mdb, image_id):
+    """List the annotations of an image."""
+    return await mdb.annotations.find({"image_id": image_id}, NO_ID).to_list(None)
+
+
+# Maps.
+async def get_maps(request):
+    """Return list of maps."""
+    maps = await request.app["mdb"].maps.find({}, NO_ID).to_list(None)
+    return respond(sorted(maps, key=lambda x: x["start"]))
+
+
+def map_package(index, map_dict):
+    """Build a map package (executor)."""
+    model = MapModel(map_dict)
+    nearby, unique = index.locate(model, model.to_alpha_beta, model.in_map)
+    return {"map": map_dict, "truth": {"nearby": nearby, "unique": unique}}
+
+
+async def get_map(request):
+    """Return a map and the ground truth on it."""
+    map_id = request.match_info["map_id"]
+    map_dict = await request.app["mdb"].maps.find_one({"map_id": map_id}, NO_ID)
+    if map_dict is None:
+        return respond({"error": "No such map."}, 404)
+    await request.app["index"].ensure_tree()
+    return respond(await run_cpu(request, map_package, request.app["index"], map_dict))
+
+
+def nearest_image_id(map_dict, images, alpha, beta):
+    """Image of the map closest to the given map position (executor)."""
+    lat, lon = MapModel(map_dict).to_lat_lon(alpha, beta)
+    positions = np.array([[img["lat"], img["lon"]] for img in images])
+    idx = np.argmin(((positions - [lat, lon]) ** 2).sum(axis=1))
+    return images[idx]["image_id"]
+
+
+async def get_map_images(request):
+    """Return the image nearest to (alpha, beta) on the map."""
+    mdb = request.app["mdb"]
+    map_id = request.match_info["map_id"]
+    alpha = float(request.query["alpha"])  # height
+    beta = float(request.query["beta"])  # width
+    map_dict = await mdb.maps.find_one({"map_id": map_id}, NO_ID)
+    projection = {"_id": 0, "image_id": 1, "lat": 1, "lon": 1}
+    images = await mdb.imagery.find({"map_id": map_id}, projection).to_list(None)
+    image_id = await run_cpu(request, nearest_image_id, map_dict, images, alpha, beta)
+    return respond([image_id])
+
+
+# Images.
+def image_package(index, image_dict):
+    """Build an image package (executor; may call exiftool for old images)."""
+    model = ImageModel(image_dict)
+    nearby, unique = index.locate(model, model.to_alpha_beta, model.in_image)
+    return {"image": image_dict, "truth": {"nearby": nearby, "unique": unique}}
+
+
+async def get_image(request):
+    """Return an image and the ground truth on it."""
+    image_id = request.match_info["image_id"]
+    image_dict = await request.app["mdb"].imagery.find_one(
+        {"image_id": image_id}, NO_ID
+    )
+    if image_dict is None:
+        return respond({"error": "No such image."}, 404)
+    await request.app["index"].ensure_tree()
+    package = await run_cpu(request, image_package, request.app["index"], image_dict)
+    return respond(package)
+
+
+def neighbor_in_direction(image_dict, images, direction):
+    """Nearest image in the half-plane of the direction (for old images)."""
+    positions = np.array([[img["lat"], img["lon"]] for img in images])
+    offset = positions - [image_dict["lat"], image_dict["lon"]]
+    along = {
+        "north": offset[:, 0],
+        "south": -offset[:, 0],
+        "east": offset[:, 1],
+        "west": -offset[:, 1],
+    }[direction]
+    distance = np.where(along > 0, np.hypot(offset[:, 0], offset[:, 1]), np.inf)
+    idx = np.argmin(distance)
+    return images[idx]["image_id"] if np.isfinite(distance[idx]) else None
+
+
+async def navigate(request):
+    """Return the package of the neighbouring image in the given direction."""
+    mdb = request.app["mdb"]
+    direction = request.query.get("direction")
+    if direction not in DIRECTIONS:
+        error = f"direction must be one of {', '.join(DIRECTIONS)}."
+        return respond({"error": error}, 400)
+    image_id = request.match_info["image_id"]
+    image_dict = await mdb.imagery.find_one({"image_id": image_id}, NO_ID)
+    if image_dict is None:
+        return respond({"error": "No such image."}, 404)
+    if "neighbors" in image_dict:
+        neighbor_id = image_dict["neighbors"][direction]
+    else:
+        projection = {"_id": 0, "image_id": 1, "lat": 1, "lon": 1}
+        query = {"map_id": image_dict["map_id"]}
+        images = await mdb.imagery.find(query, projection).to_list(None)
+        neighbor_id = await run_cpu(
+            request, neighbor_in_direction, image_dict, images, direction
+        )
+    if neighbor_id is None:
+        return respond({"error": f"No image to the {direction} of this one."}, 404)
+    neighbor = await mdb.imagery.find_one({"image_id": neighbor_id}, NO_ID)
+    await request.app["index"].ensure_tree()
+    package = await run_cpu(request, image_package, request.app["index"], neighbor)
+    return respond(package)
+
+
+# Targets.
+async def get_targets(request):
+    """Return annotation targets."""
+    targets = await request.app["mdb"].targets.find({}, NO_ID).to_list(None)
+    return respond(sorted(targets, key=lambda x: x["scientific_name"]))
+
+
+async def post_target(request):
+    """Add a new target."""
+    try:
+        await request.app["mdb"].targets.insert_one(await request.json())
+    except pymongo.errors.DuplicateKeyError:
+        print("Sorry. Target already exists.")
+    await request.app["index"].load_targets()
+    return await get_targets(request)
+
+
+async def put_target(request):
+    """Update a target."""
+    target = await request.json()
+    target.pop("_id", None)
+    await request.app["mdb"].targets.update_one(
+        {"scientific_name": target["scientific_name"]}, {"$set": target}
+    )
+    await request.app["index"].load_targets()
+    return await get_targets(request)
+
+
+async def delete_target(request):
+    """Delete the specified target."""
+    target_id = request.match_info["target_id"]
+    await request.app["mdb"].targets.delete_one({"scientific_name": target_id})
+    await request.app["index"].load_targets()
+    return await get_targets(request)
+
+
+# Annotations.
+async def post_annotation(request):
+    """Add the provided annotation to the database."""
+    mdb = request.app["mdb"]
+    data = await request.json()
+    try:
+        await mdb.annotations.insert_one(data)
+    except pymongo.errors.DuplicateKeyError:
+        print("> Sorry, that point is already annotated.")
+    return respond(await get_annotations_for_image(mdb, data["image_id"]))
+
+
+async def post_annotation_batch(request):
+    """Apply many annotation creates/deletes in one unordered bulk write."""
+    mdb = request.app["mdb"]
+    operations = (await request.json()).get("operations", [])
+    requests, request_idx, results, delete_ids = plan_annotation_writes(operations)
+    query = {"annotation_id": {"$in": delete_ids}}
+    existing = {
+        a["annotation_id"]: a
+        for a in await mdb.annotations.find(query, NO_ID).to_list(None)
+    }
+    errors = {}
+    if len(requests) > 0:
+        try:
+            await mdb.annotations.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            errors = {e["index"]: e for e in error.details["writeErrors"]}
+    query = {"annotation_id": {"$in": list(existing)}}
+    projection = {"_id": 0, "annotation_id": 1}
+    remaining = {
+        a["annotation_id"]
+        for a in await mdb.annotations.find(query, projection).to_list(None)
+    }
+    return respond(
+        summarize_annotation_writes(
+            operations, request_idx, results, errors, existing, remaining
+        )
+    )
+
+
+async def get_image_annotations(request):
+    """Return all available annotations for a specific image."""
+    image_id = request.match_info["image_id"]
+    return respond(await get_annotations_for_image(request.app["mdb"], image_id))
+
+
+async def delete_image_annotations(request):
+    """Delete all annotations on an image."""
+    mdb = request.app["mdb"]
+    image_id = request.match_info["image_id"]
+    await mdb.annotations.delete_many({"image_id": image_id})
+    return respond(await get_annotations_for_image(mdb, image_id))
+
+
+async def delete_annotation(request):
+    """Delete an individual annotation."""
+    mdb = request.app["mdb"]
+    annotation_id = request.match_info["annotation_id"]
+    annotation = await mdb.annotations.find_one_and_delete(
+        {"annotation_id": annotation_id}
+    )
+    if annotation is None:
+        return respond([])
+    return respond(await get_annotations_for_image(mdb, annotation["image_id"]))
+
+
+# Ground truth.
+async def post_truth(request):
+    """Create a new post-field ground truth point."""
+    mdb = request.app["mdb"]
+    data = await request.json()
+    tile_dict = await mdb.tiles.find_one({"tile_id": data["image_id"]}, NO_ID)
+    truth = machine_truth_on_tile(data, tile_dict)
+    await mdb.ground_truth.insert_one(truth)
+    request.app["index"].add_truth(truth)
+    return respond(200)
+
+
+async def delete_truths(request):
+    """Delete all post-field ground truth from given image."""
+    image_id = request.match_info["image_id"]
+    await request.app["mdb"].ground_truth.delete_many({"image_id": image_id})
+    request.app["index"].remove_truths(image_id)
+    return respond(200)
+
+
+async def on_startup(app):
+    """Connect to MongoDB and load the truth index."""
+    app["client"] = AsyncIOMotorClient(MONGO_URI)
+    app["mdb"] = app["client"][DATABASE_NAME]
+    app["executor"] = ThreadPoolExecutor()
+    app["index"] = TruthIndex(app["mdb"])
+    await app["index"].load()
+
+
+async def on_cleanup(app):
+    """Release the connection and the executor."""
+    app["client"].close()
+    app["executor"].shutdown(wait=False)
+
+
+def create_app():
+    """Build the aiohttp application with the same routes as api.py."""
+    app = web.Application(middlewares=[cors])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_get("/maps", get_maps)
+    app.router.add_get("/maps/{map_id}", get_map)
+    app.router.add_get("/map-images/{map_id}/", get_map_images)
+    app.router.add_get("/images/navigate/{image_id}", navigate)
+    app.router.add_get("/images/{image_id}", get_image)
+    app.router.add_get("/targets", get_targets)
+    app.router.add_post("/targets", post_target)
+    app.router.add_put("/targets/{target_id}", put_target)
+    app.router.add_delete("/targets/{target_id}", delete_target)
+    app.router.add_post("/annotations", post_annotation)
+    app.router.add_post("/annotations/batch", post_annotation_batch)
+    app.router.add_get("/annotations/{image_id}", get_image_annotations)
+    app.router.add_delete("/annotations/{image_id}", delete_image_annotations)
+    app.router.add_delete("/annotation/{annotation_id}", delete_annotation)
+    app.router.add_post("/truths", post_truth)
+    app.router.add_delete("/truths/{image_id}", delete_truths)
+    return app
+
+
+if __name__ == "__main__":
+    from getpass import getuser
+
+    host = "localhost"
+    if getuser() == "mlewis":  # we're on Zee
+        host = "192.168.40.5"
+    web.run_app(create_app(), host=host, port=PORT)
@@ -0,0 +1,161 @@
+"""Benchmark import time of the entry points and first use of the database.
+
+Every measurement runs in a fresh interpreter, so nothing is already
+imported, connected or built:
+
+    python bench_imports.py --repeats 5 --save import_times.json
+    python bench_imports.py --baseline import_times.json  # fail on regressions
+    python bench_imports.py --breakdown export  # slowest imports of one module
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+
+# Scripts and servers whose import time we care about.
+ENTRY_POINTS = [
+    "api",
+    "async_api",
+    "export",
+    "generate_batch",
+    "ingest",
+    "update_database",
+    "read_kml",
+    "map_pyramid",
+    "map_maker",
+    "performance_metrics",
+    "heat_map_visualization",
+    "train_cnn",
+    "verify_indexes",
+]
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+# Snippets timed in a fresh process; each prints the seconds it measured.
+SNIPPETS = {
+    "import database": """
+import time
+start = time.perf_counter()
+import database
+print(time.perf_counter() - start)
+""",
+    "first query (connect)": """
+from database import db
+import time
+start = time.perf_counter()
+db.get_maps()
+print(time.perf_counter() - start)
+""",
+    "truth tree (built)": """
+import os
+os.environ["ARGOS_TREE_CACHE"] = "0"
+from database import db
+db.get_maps()
+import time
+start = time.perf_counter()
+db.truth_tree
+print(time.perf_counter() - start)
+""",
+    "truth tree (from cache)": """
+from database import db
+db.get_maps()
+import time
+start = time.perf_counter()
+db.truth_tree
+print(time.perf_counter() - start)
+""",
+}
+
+
+def run_snippet(snippet):
+    """Run a snippet in a fresh interpreter; return the seconds it printed."""
+    result = subprocess.run(
+        [sys.executable, "-c", snippet], capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def import_breakdown(module, top=15):
+    """The slowest (cumulative) imports made by importing module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [field.strip() for field in line[12:].split("|")]
+        rows.append((int(cumulative) / 1e6, name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def regressions(results, baseline, tolerance=1.25, slack=0.02):
+    """Entries more than tolerance times (plus slack seconds) slower than before."""
+    return {
+        name: (baseline[name], seconds)
+        for name, seconds in results.items()
+        if name in baseline and seconds > baseline[name] * tolerance + slack
+    }
+
+
+def median(values):
+    """Median of a list."""
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark(snippets, repeats=5):
+    """Median seconds per snippet."""
+    results = {}
+    for name, snippet in snippets.items():
+        try:
+            run_snippet(snippet)  # warm the OS page cache (and the tree cache)
+        except subprocess.CalledProcessError as error:
+            print(f"> Skipping {name}: {error.stderr.strip().splitlines()[-1]}")
+            continue
+        results[name] = median([run_snippet(snippet) for _ in range(repeats)])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    parser.add_argument("--breakdown", help="list the slowest imports of a module")
+    args = parser.parse_args()
+
+    if args.breakdown:
+        for seconds, name in import_breakdown(args.breakdown):
+            print(f"> {name:<45} {seconds * 1000:9.1f} ms")
+        sys.exit(0)
+
+    snippets = {f"import {m}": IMPORT_SNIPPET.format(module=m) for m in ENTRY_POINTS}
+    snippets.update(SNIPPETS)
+    results = benchmark(snippets, args.repeats)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, seconds in results.items():
+            print(f"> {name:<45} {seconds * 1000:9.1f} ms")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.tolerance)
+        for name, (before, after) in slower.items():
+            print(f"> REGRESSION {name}: {before * 1000:.1f} -> {after * 1000:.1f} ms")
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,47 @@
+"""Benchmark JSON serialization time and payload size of the map packages."""
+from database import db
+from models import MapModel
+import serialization
+from serialization import compress, default, dumps
+
+import json
+import time
+
+
+def time_call(func, nb_repeats=20):
+    """Best-of-n wall time of func(), in milliseconds."""
+    best = float("inf")
+    for _ in range(nb_repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+if __name__ == "__main__":
+
+    # Build the package of every map; benchmark the five largest.
+    packages = []
+    for map_dict in db.get_maps():
+        try:
+            packages.append((map_dict["map_id"], MapModel(map_dict).package()))
+        except ValueError:  # no boundary information for this map
+            continue
+    packages = sorted(packages, key=lambda p: -len(p[1]["truth"]["nearby"]))[:5]
+
+    header = ["json ms", "fast ms", "raw KB", "gzip KB", "br KB"]
+    print(f"{'map_id':<40}" + "".join(f"{h:>9}" for h in header))
+    for map_id, package in packages:
+        json_ms = time_call(lambda: json.dumps(package, default=default).encode())
+        fast_ms = time_call(lambda: dumps(package))
+        body = dumps(package)
+        gzip_kb = len(compress(body, "gzip")) / 1024
+        br_kb = float("nan")
+        if serialization.brotli is not None:
+            br_kb = len(compress(body, "br")) / 1024
+        print(
+            f"{map_id:<40}{json_ms:>9.2f}{fast_ms:>9.2f}"
+            f"{len(body) / 1024:>9.1f}{gzip_kb:>9.1f}{br_kb:>9.1f}"
+        )
+    if serialization.orjson is None:
+        print("> orjson is not installed; the fast path falls back to json.")
@@ -1,20 +1,65 @@
 """Train a CNN to identify invasive species."""
-from config import *
-from generate_batch import *
-from utils import *
-
-from glob import glob
-from keras.callbacks import ModelCheckpoint
-from keras.models import load_model, Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten
-from keras.optimizers import Adam
-from keras.layers.normalization import BatchNormalization
-from keras.utils import np_utils
-from keras.layers import Conv2D, MaxPooling2D, ZeroPadding2D, GlobalAveragePooling2D
+from generate_batch import create_batch
+from model_registry import model_location, model_name, registry
+from utils import extract_tiles, image_location_to_id
+from vessel import Vessel
+
+import hashlib
+import numpy as np
+import os
 from subprocess import Popen
 from tqdm import tqdm
 
 
+def grid_positions(nb_alpha=40, nb_beta=40, jitter=0.01, seed=None):
+    """Jittered (alpha, beta) grid over an image, row by row.
+
+    With a seed the jitter is reproducible, so repeated scans can be cached.
+    """
+    rng = np.random.RandomState(seed)
+    alpha, beta = np.meshgrid(
+        np.linspace(0, 1, nb_alpha), np.linspace(0, 1, nb_beta), indexing="ij"
+    )
+    grid = np.column_stack([alpha.ravel(), beta.ravel()])
+    return grid, grid + jitter * rng.randn(*grid.shape)
+
+
+def node_lines(nb_nodes, step):
+    """Grid lines every step nodes, always including the last node."""
+    return np.union1d(np.arange(0, nb_nodes, step), [nb_nodes - 1])
+
+
+def fill_grid(positions, prob, nb_alpha=40, nb_beta=40):
+    """Full (nb_alpha, nb_beta) probability grid from a (possibly sparse) scan.
+
+    Positions are snapped to the nearest node (several at one node are
+    averaged); nodes that were not evaluated take the value of the nearest
+    evaluated node.
+    """
+    positions = np.asarray(positions)
+    i = np.rint(np.clip(positions[:, 0], 0, 1) * (nb_alpha - 1)).astype(int)
+    j = np.rint(np.clip(positions[:, 1], 0, 1) * (nb_beta - 1)).astype(int)
+    flat = i * nb_beta + j
+    total = np.bincount(flat, prob, minlength=nb_alpha * nb_beta)
+    count = np.bincount(flat, minlength=nb_alpha * nb_beta)
+    grid = np.full(nb_alpha * nb_beta, np.nan)
+    grid[count > 0] = total[count > 0] / count[count > 0]
+    grid = grid.reshape(nb_alpha, nb_beta)
+    missing = np.isnan(grid)
+    if missing.any():
+        from scipy.spatial import cKDTree
+
+        evaluated = np.argwhere(~missing)
+        _, nearest = cKDTree(evaluated).query(np.argwhere(missing))
+        grid[missing] = grid[tuple(evaluated[nearest].T)]
+    return grid
+
+
+def image_seed(image_id):
+    """Reproducible random seed for an image."""
+    return int(hashlib.sha1(image_id.encode()).hexdigest()[:8], 16)
+
+
 class CNN:
     """Basic CNN for image invasive species detection."""
 
@@ -30,22 +75,26 @@ class CNN:
     ):
         """Set up the basic convolutional neural network model."""
         self.scientific_name = scientific_name
-        self.model_name = model_name = scientific_name.replace(" ", "_").lower()
-        self.model_location = f"{MODEL_LOCATION}/{model_name}.h5"
+        self.model_name = model_name(scientific_name)
+        self.model_location = model_location(scientific_name)
         self.tiles_per_class = tiles_per_class
         self.samples_per_tile = samples_per_tile  # i.e., number rotations per tile
         self.nb_epochs_per_iter = nb_epochs_per_iter
         self.nb_iter = nb_iter
         self.tile_size = tile_size
-        if do_load_model and len(glob(self.model_location)) > 0:
-            print("Loading model.")
-            self.model = load_model(self.model_location)
+        if do_load_model and registry.has(scientific_name):
+            self.model = registry.get(scientific_name)  # shared, loaded once
         else:
             print("Building model from scratch.")
             self.build_model()
 
     def build_model(self):
         """Build the convolutional neural network."""
+        from keras.models import Sequential
+        from keras.layers import Activation, Conv2D, Dense, Dropout, Flatten
+        from keras.layers import MaxPooling2D
+        from keras.layers.normalization import BatchNormalization
+
         tile_size = self.tile_size
 
         # Build the CNN.
@@ -122,10 +171,13 @@ class CNN:
             # Fit the network to the current batch of data
             self.model.fit(X, y, epochs=self.nb_epochs_per_iter, validation_split=0.1)
             self.model.save(self.model_location)
+            registry.register(self.scientific_name, self.model)
 
     def set_image(self, path_to_image):
         """Load an image into memory."""
-        self.image = plt.imread(path_to_image)
+        from pylab import imread  # matplotlib is slow to import
+
+        self.image = imread(path_to_image)
         self.image_height, self.image_width, _ = self.image.shape
 
     def predict(self, position, tile_size=128):
@@ -139,6 +191,179 @@ class CNN:
         prob = self.model.predict([tile])
         return prob[0][0]
 
+    def predict_batch(self, positions, batch_size=256):
+        """Predict the class of the tiles at many (alpha, beta) positions at once."""
+        tiles = []
+        for alpha, beta in positions:
+            tiles.extend(
+                extract_tiles(
+                    self.image,
+                    self.image_height * alpha,
+                    self.image_width * beta,
+                    size=self.tile_size,
+                    num_rotations=1,
+                    jitter_amplitude=0,
+                )
+            )
+        prob = self.model.predict(np.array(tiles), batch_size=batch_size)
+        return prob[:, 0]
+
+    def scan_image(
+        self, path_to_image, seed=None, nb_alpha=40, nb_beta=40, jitter=0.01
+    ):
+        """Evaluate the CNN on a jittered grid; return (grid positions, prob)."""
+        self.set_image(path_to_image)
+        grid, jittered = grid_positions(nb_alpha, nb_beta, jitter, seed)
+        return grid, self.predict_batch(jittered)
+
+    def scan_image_adaptive(
+        self,
+        path_to_image,
+        seed=None,
+        nb_alpha=40,
+        nb_beta=40,
+        jitter=0.01,
+        coarse_step=8,
+        threshold=0.5,
+        disagreement=0.25,
+    ):
+        """Evaluate a coarse grid, then refine only cells that may hold targets.
+
+        A cell (between grid lines coarse_step nodes apart, a power of two) is
+        split in four when a corner exceeds threshold or its corners differ by
+        more than disagreement; this repeats down to single nodes. Returns
+        (grid positions, prob) for the evaluated nodes only: a subset of
+        scan_image's grid, with the same jitter, so the values agree.
+        """
+        if coarse_step < 1 or coarse_step & (coarse_step - 1):
+            raise ValueError(f"coarse_step must be a power of two, not {coarse_step}.")
+        self.set_image(path_to_image)
+        grid, jittered = grid_positions(nb_alpha, nb_beta, jitter, seed)
+        prob = np.full(nb_alpha * nb_beta, np.nan)
+
+        def evaluate(flat):
+            """Run the CNN, in one batch, on the nodes not evaluated yet."""
+            flat = np.unique(flat[np.isnan(prob[flat])])
+            if len(flat) > 0:
+                prob[flat] = self.predict_batch(jittered[flat])
+
+        step = coarse_step
+        rows, cols = node_lines(nb_alpha, step), node_lines(nb_beta, step)
+        evaluate((rows[:, None] * nb_beta + cols[None, :]).ravel())
+        while step > 1:
+            half = step // 2
+            rows, cols = node_lines(nb_alpha, step), node_lines(nb_beta, step)
+            p = prob.reshape(nb_alpha, nb_beta)
+            corners = np.array(
+                [
+                    p[np.ix_(rows[:-1], cols[:-1])],
+                    p[np.ix_(rows[:-1], cols[1:])],
+                    p[np.ix_(rows[1:], cols[:-1])],
+                    p[np.ix_(rows[1:], cols[1:])],
+                ]
+            )
+            # Cells of unrefined parents have unevaluated (NaN) corners: skipped.
+            refine = (corners.max(axis=0) > threshold) | (
+                np.ptp(corners, axis=0) > disagreement
+            )
+            refined = np.argwhere(refine)
+            if len(refined) > 0:
+                new_rows, new_cols = [], []
+                for r, c in refined:
+                    r_lines = np.union1d(
+                        np.arange(rows[r], rows[r + 1], half), [rows[r + 1]]
+                    )
+                    c_lines = np.union1d(
+                        np.arange(cols[c], cols[c + 1], half), [cols[c + 1]]
+                    )
+                    new_rows.append(np.repeat(r_lines, len(c_lines)))
+                    new_cols.append(np.tile(c_lines, len(r_lines)))
+                evaluate(np.concatenate(new_rows) * nb_beta + np.concatenate(new_cols))
+            step = half
+        evaluated = ~np.isnan(prob)
+        return grid[evaluated], prob[evaluated]
+
+    def scan_image_sampled(
+        self, path_to_image, seed=None, budget=400, nb_chains=32, floor=0.01
+    ):
+        """Spend at most budget CNN evaluations where the probability is high.
+
+        Parallel Metropolis-Hastings chains over (alpha, beta) use the CNN
+        probability (plus floor, so chains can cross negative ground) as their
+        target, one batch per step. Returns (positions, prob) of every position
+        evaluated, like scan_image, so results store and map like grid scans.
+        """
+        from mcmc import sample_chains  # scipy.stats is slow to import
+
+        self.set_image(path_to_image)
+        nb_chains = min(nb_chains, budget)
+        positions, prob = [], []
+
+        def target(x):
+            """CNN probability of a batch of positions (all of them are kept)."""
+            p = self.predict_batch(x)
+            positions.append(np.array(x))
+            prob.append(p)
+            return p + floor
+
+        nb_iter = (budget - nb_chains) // nb_chains  # out-of-bounds steps are free
+        sample_chains(target, nb_chains, nb_iter, burn_in=0.5, scale=0.1, seed=seed)
+        return np.concatenate(positions), np.concatenate(prob)
+
+    def compare_scans(self, paths_to_images, seeds=None, threshold=0.5, **kwargs):
+        """Recall and CNN evaluations saved by the adaptive scan, per image.
+
+        Every image is scanned both ways, with the same jitter (seeded from the
+        image_id unless seeds are given, as map_maker does); recall is the
+        fraction of the full grid's detections (prob > threshold) that the
+        adaptive scan also finds.
+        """
+        report = []
+        seeds = seeds or [None] * len(paths_to_images)
+        for path_to_image, seed in zip(paths_to_images, seeds):
+            if seed is None:
+                seed = image_seed(image_location_to_id(path_to_image))
+            grid, prob = self.scan_image(path_to_image, seed=seed)
+            positions, prob_ = self.scan_image_adaptive(
+                path_to_image, seed=seed, threshold=threshold, **kwargs
+            )
+            found = {tuple(x) for x in positions[prob_ > threshold]}
+            targets = [tuple(x) for x in grid[prob > threshold]]
+            recall = np.mean([x in found for x in targets]) if targets else 1.0
+            saved = 1 - len(prob_) / len(prob)
+            print(
+                f"> {path_to_image}: {len(prob_)} of {len(prob)} evaluations "
+                f"({saved:.0%} saved), recall {recall:.3f}"
+            )
+            report.append(
+                {
+                    "path_to_image": path_to_image,
+                    "evaluations": len(prob_),
+                    "grid_evaluations": len(prob),
+                    "saved": saved,
+                    "recall": recall,
+                }
+            )
+        return report
+
+    def weights_hash(self):
+        """Hash of the model weights (of the saved file, if there is one)."""
+        path = self.model_location
+        if os.path.exists(path):
+            stat = os.stat(path)
+            key = (path, stat.st_mtime, stat.st_size)
+            if getattr(self, "_weights_key", None) != key:
+                sha1 = hashlib.sha1()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        sha1.update(chunk)
+                self._weights_key, self._weights_hash = key, sha1.hexdigest()
+            return self._weights_hash
+        sha1 = hashlib.sha1()
+        for weights in self.model.get_weights():
+            sha1.update(np.ascontiguousarray(weights).tobytes())
+        return sha1.hexdigest()
+
 
 if __name__ == "__main__":
     training = False
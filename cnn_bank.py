@@ -1,28 +1,43 @@
 """A bank of convolutional neural networks, one for each species of interest."""
-from config import *
+from model_registry import model_location, registry
 
-from keras.models import load_model
+
+class BankModels:
+    """Mapping of species code to model; models load on first access."""
+
+    def __init__(self, soi_codes):
+        """Models for these codes are available."""
+        self.soi_codes = soi_codes
+
+    def __getitem__(self, code):
+        """Return the (cached) model for a species code."""
+        if code not in self.soi_codes:
+            raise KeyError(code)
+        return registry.get(code)
+
+    def __contains__(self, code):
+        return code in self.soi_codes
+
+    def keys(self):
+        return list(self.soi_codes)
 
 
 class NeuralBank:
     """Hold on to neural networks for species of interest (SoI)."""
 
     def __init__(self, soi_codes=[14, 28]):
-        """Specify species models to build."""
+        """Specify species models to use (loaded lazily, via the registry)."""
         self.soi_codes = soi_codes
-        self.cnn_locations = {
-            code: f"{MODEL_LOCATION}/cnn_{code:02d}.h5" for code in soi_codes
-        }
-        self.load_models()
+        self.cnn_locations = {code: model_location(code) for code in soi_codes}
+        self.models = BankModels(soi_codes)
 
     def load_models(self):
-        """Loading the neural network models."""
-        self.models = {}
+        """Load all the neural network models now."""
         for code in self.soi_codes:
             print(f"> Loading CNN for species code {code:02d}.")
-            self.models[code] = load_model(self.cnn_locations[code])
+            self.models[code]
             print("> Complete.")
 
 
-# Load the NeuralBank (for import into other scripts).
+# The NeuralBank (for import into other scripts); nothing loads until used.
 bank = NeuralBank()
@@ -0,0 +1,29 @@
+"""Cooperative concurrency helpers for the eventlet-based API server.
+
+The API runs on eventlet green threads. Once the standard library is
+monkey-patched, MongoDB round trips yield to other requests while they wait
+on the network. CPU-bound work (georeferencing, raster rendering, image
+decoding) and the exiftool subprocess would still stall the hub, so they
+are handed to eventlet's pool of native threads via offload().
+"""
+GREEN = False  # set once enable_green_threads() has run
+
+
+def enable_green_threads():
+    """Monkey-patch blocking I/O; must run before pymongo/threading are imported."""
+    global GREEN
+    import eventlet
+
+    # os stays unpatched so exiftool's pipe reads work inside native threads.
+    eventlet.monkey_patch(os=False)
+    GREEN = True
+
+
+def offload(func, *args, **kwargs):
+    """Run func in a native thread when green threads are on; else call it."""
+    if GREEN:
+        from eventlet import tpool
+        from metrics import carry
+
+        return tpool.execute(carry(func), *args, **kwargs)
+    return func(*args, **kwargs)
@@ -1,6 +1,7 @@
 """Useful configuration parameters and constants."""
 import getpass
 from glob import glob
+import os
 
 
 # Find the current user.
@@ -286,6 +287,12 @@ CONFUSORS["Hydrocharis morsus-ranae"] = [
     "Thuja occidentalis",
 ]
 
+# Defaults for anyone not listed below (point ARGOS_ROOT at the data).
+ARGOS_ROOT = os.environ.get("ARGOS_ROOT", os.path.expanduser("~/ARGOS"))
+TARGET_FILE = "truth/target_key.xlsx"
+TRUTH_FILES = glob("truth/*.shp")
+MODEL_LOCATION = "data/models"
+
 # Determine location of image data based on current user.
 if user == "mjl":
     ARGOS_ROOT = "/Users/mjl/Dropbox (Personal)/MAC/DEPOT/ARGOS"
@@ -300,3 +307,16 @@ elif user == "jgc":  # we're on Josh's laptop
 elif user == "mlewis":  # we're deployed on Zee
     ARGOS_ROOT = "/mnt/scratch/ARGOS"
     MODEL_LOCATION = "data/models"
+
+# MongoDB connection; point ARGOS_DATABASE at a scratch database for load tests.
+MONGO_URI = os.environ.get("ARGOS_MONGO_URI", "mongodb://localhost:27017")
+DATABASE_NAME = os.environ.get("ARGOS_DATABASE", "ARGOS")
+
+# Spatial queries: "balltree" (in-process trees) or "mongo" (2dsphere indexes).
+SPATIAL_BACKEND = os.environ.get("ARGOS_SPATIAL_BACKEND", "balltree")
+
+# Save BallTrees to disk so other processes can load them instead of rebuilding.
+TREE_CACHE = os.environ.get("ARGOS_TREE_CACHE", "1") == "1"
+
+# Sample stacks of API requests slower than this many milliseconds (off if unset).
+PROFILE_SLOW_MS = os.environ.get("ARGOS_PROFILE_SLOW_MS")
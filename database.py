@@ -1,23 +1,48 @@
 """Utilities for accessing the database, grabbing data, etc."""
-from config import *
-from geo_utils import distance_on_earth
-from utils import *
+from config import (
+    ARGOS_ROOT,
+    CONFUSORS,
+    DATABASE_NAME,
+    MONGO_URI,
+    SPATIAL_BACKEND,
+    TREE_CACHE,
+)
+from geo_utils import DIRECTIONS, directional_neighbors, geo_point
+from metrics import MongoTimer, timer
+from utils import extract_tiles, fix_image_id, parse_image_id, prepend_argos_root
 
-from bson import ObjectId
-from datetime import datetime
-from exiftool import ExifTool
 from glob import glob
-from ipdb import set_trace as debug
+import hashlib
 import numpy as np
 import pymongo
-from pymongo import MongoClient
+from pymongo import DeleteMany, InsertOne, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 import os
-import re
-from sklearn.neighbors import BallTree
+import pickle
+import threading
+
+__all__ = [
+    "Database",
+    "INDEXES",
+    "LazyDatabase",
+    "db",
+    "document_location",
+    "extract_smart_training_tiles",
+    "extract_tiles_from_annotation",
+    "extract_training_tiles",
+    "field_projection",
+    "get_specified_target",
+    "plan_annotation_writes",
+    "smart_batch",
+    "summarize_annotation_writes",
+    "tile_map_id",
+]
 
 
 def extract_tiles_from_annotation(annotation, samples_per_tile):
     """Open up an image and extract tiles."""
+    import matplotlib.pyplot as plt
+
     image_id = fix_image_id(annotation["image_id"])
     image_dict = parse_image_id(image_id)
     try:  # directory may not exist... maps not uploaded yet, e.g.
@@ -71,12 +96,20 @@ def smart_batch(
             nb_tiles_per_class=nb_tiles_per_confusor,
             samples_per_tile=samples_per_tile,
         )
-        if X_ is not None:
-            try:
-                X = np.vstack((X, X_))
-                y = np.hstack((y, y_))
-            except:
-                debug()
+        if X_ is None:
+            continue
+        if X is None:
+            X, y = X_, y_
+        elif X_.shape[1:] != X.shape[1:]:
+            raise ValueError(
+                f"Tiles of confusor {confusor} have shape {X_.shape[1:]}, "
+                f"but the target tiles have shape {X.shape[1:]}."
+            )
+        else:
+            X = np.vstack((X, X_))
+            y = np.hstack((y, y_))
+    if X is None:
+        raise ValueError(f"No training tiles found for {scientific_name}.")
     idx = np.arange(X.shape[0])
     np.random.shuffle(idx)
     X = X[idx, :]
@@ -156,59 +189,221 @@ def extract_training_tiles(
     return np.array(X), np.array(y)
 
 
+def plan_annotation_writes(operations):
+    """Turn annotation create/delete operations into unordered bulk requests.
+
+    Operations look like {"op": "create", "annotation": {...}} or
+    {"op": "delete", "annotation_id": ...}. An annotation_id may appear in one
+    operation per batch; later ones are rejected as conflicts, so the outcome
+    does not depend on the order an unordered bulk write runs them in. Creates
+    become one InsertOne each, deletes a single DeleteMany (the last request).
+    Returns the requests, the index of the create behind each InsertOne, the
+    (partially filled) per-item results, and the ids slated for deletion.
+    """
+    requests = []
+    request_idx = []
+    results = [None] * len(operations)
+    delete_ids = []
+    seen = set()
+    for itr, op in enumerate(operations):
+        kind = op.get("op")
+        if kind == "create" and "annotation_id" in op.get("annotation", {}):
+            annotation_id = op["annotation"]["annotation_id"]
+        elif kind == "delete" and "annotation_id" in op:
+            annotation_id = op["annotation_id"]
+        else:
+            results[itr] = {"status": "invalid"}
+            continue
+        if annotation_id in seen:
+            results[itr] = {"status": "conflict", "annotation_id": annotation_id}
+            continue
+        seen.add(annotation_id)
+        if kind == "create":
+            requests.append(InsertOne(dict(op["annotation"])))
+            request_idx.append(itr)
+        else:
+            delete_ids.append(annotation_id)
+    if len(delete_ids) > 0:
+        requests.append(DeleteMany({"annotation_id": {"$in": delete_ids}}))
+    return requests, request_idx, results, delete_ids
+
+
+def summarize_annotation_writes(
+    operations, request_idx, results, errors, existing, remaining
+):
+    """Fill in per-item status and collect the annotations that changed.
+
+    existing maps the ids slated for deletion to their annotations before the
+    write; remaining holds those still there after it. Only annotations that
+    were there before and are gone after are reported deleted.
+    """
+    created = []
+    deleted = []
+    for request_nb, itr in enumerate(request_idx):
+        annotation = dict(operations[itr]["annotation"])
+        annotation_id = annotation["annotation_id"]
+        if request_nb in errors:
+            duplicate = errors[request_nb]["code"] == 11000
+            status = "duplicate" if duplicate else "error"
+        else:
+            status = "created"
+            annotation.pop("_id", None)
+            created.append(annotation)
+        results[itr] = {"status": status, "annotation_id": annotation_id}
+    delete_failed = len(request_idx) in errors  # the DeleteMany comes last
+    for itr, op in enumerate(operations):
+        if results[itr] is not None:
+            continue
+        annotation_id = op["annotation_id"]
+        if delete_failed:
+            status = "error"
+        elif annotation_id in existing and annotation_id not in remaining:
+            status = "deleted"
+            deleted.append(existing[annotation_id])
+        else:
+            status = "not_found"
+        results[itr] = {"status": status, "annotation_id": annotation_id}
+    return {"results": results, "created": created, "deleted": deleted}
+
+
+ASC = pymongo.ASCENDING
+
+# Indexes per collection as (keys, options), matching the hot access paths.
+INDEXES = {
+    "maps": [([("map_id", ASC)], {"unique": True})],
+    "targets": [([("scientific_name", ASC)], {"unique": True})],
+    "imagery": [
+        ([("image_id", ASC)], {"unique": True}),
+        # Covers the per-map position lookups (e.g., build_image_neighbors).
+        ([("map_id", ASC), ("image_id", ASC), ("lat", ASC), ("lon", ASC)], {}),
+    ],
+    "tiles": [([("tile_id", ASC)], {"unique": True})],
+    "ground_truth": [
+        ([("image_id", ASC)], {"sparse": True}),  # field truths have neither
+        ([("tile_id", ASC)], {"sparse": True}),
+        ([("code", ASC)], {}),
+    ],
+    "annotations": [
+        ([("annotation_id", ASC)], {"unique": True}),
+        ([("image_id", ASC), ("annotation_id", ASC)], {}),
+        ([("tile_id", ASC), ("annotation_id", ASC)], {}),
+        ([("scientific_name", ASC), ("image_id", ASC)], {}),
+    ],
+}
+
+# Indexes made redundant by a compound index above; dropped by ensure_indexes().
+REDUNDANT_INDEXES = {"annotations": ["scientific_name_1"]}
+
+
+# BallTrees per kind of document: the collection they index. Built on first use
+# and, if TREE_CACHE is on, saved under TREE_CACHE_LOCATION keyed by the
+# collection's version so other processes can load instead of rebuild.
+SPATIAL_INDEXES = {"image": "imagery", "tile": "tiles", "truth": "ground_truth"}
+TREE_CACHE_LOCATION = f"{ARGOS_ROOT}/cache/trees"
+
+
+def field_projection(fields, sort_key):
+    """Projection keeping only fields (and the sort key); all fields if None."""
+    if fields is None:
+        return {"_id": 0}
+    projection = {field: 1 for field in fields}
+    projection[sort_key] = 1
+    projection.setdefault("_id", 0)
+    return projection
+
+
+def tile_map_id(tile_id):
+    """The map a tile belongs to (its tile_id without the TILE_ part)."""
+    return "-".join(tile_id.split("-")[:-1])
+
+
+def document_location(doc):
+    """GeoJSON location of a ground truth, tile or image document."""
+    if "latlon" in doc:  # ground truth
+        lat, lon = doc["latlon"]
+    elif "north" in doc:  # tile; use its center
+        lat = (doc["north"] + doc["south"]) / 2
+        lon = (doc["east"] + doc["west"]) / 2
+    else:  # image
+        lat, lon = doc["lat"], doc["lon"]
+    return geo_point(lat, lon)
+
+
 class Database:
     """Handle resource CRUD."""
 
     def __init__(self):
         """Define collections."""
-        client = MongoClient()
-        db = client.ARGOS
+        # Every command's round trip is charged to the current API request.
+        client = MongoClient(MONGO_URI, event_listeners=[MongoTimer()])
+        self.db = db = client[DATABASE_NAME]
 
-        # Create maps collection.
+        # Collections; their indexes are declared in INDEXES.
         self.maps = db.maps
-        self.maps.create_index([("map_id", pymongo.ASCENDING)], unique=True)
-
-        # Create target collection.
         self.targets = db.targets
-        self.targets.create_index([("scientific_name", pymongo.ASCENDING)], unique=True)
-
-        # Create ground truth collection.
         self.ground_truths = db.ground_truth
-        # self.ground_truths.create_index([("datetime", pymongo.ASCENDING)], unique=True)
-
-        # Create the imagery collection.
         self.imagery = db.imagery
-        self.imagery.create_index([("image_id", pymongo.ASCENDING)], unique=True)
-
-        # Create the imagery collection.
         self.tiles = db.tiles
-        self.tiles.create_index([("tile_id", pymongo.ASCENDING)], unique=True)
-
-        # Annotations collection.
         self.annotations = db.annotations
-        self.annotations.create_index(
-            [("annotation_id", pymongo.ASCENDING)], unique=True
-        )
-        self.annotations.create_index([("scientific_name", pymongo.ASCENDING)])
-        if self.imagery.count_documents({}) > 0:
-            self.build_image_tree()
-        if self.tiles.count_documents({}) > 0:
-            self.build_tile_tree()
-        if self.ground_truths.count_documents({}) > 0:
-            self.build_truth_tree()
+        self.ensure_indexes()
+
+        # Callbacks notified with the lat/lon of truths touched by a write.
+        self.listeners = []
+
+        # With the mongo backend, spatial queries run on 2dsphere indexes and no
+        # trees are built in this process; otherwise trees are built lazily.
+        self.use_trees = SPATIAL_BACKEND != "mongo"
+        self.spatial_indexes = {}
+        self.tree_lock = threading.Lock()
+        if not self.use_trees:
+            self.ensure_geo_indexes()
 
     def get_tile(self, tile_id):
         """Retrieve a tile via its tile_id."""
         return self.tiles.find_one({"tile_id": tile_id}, {"_id": 0})
 
-    def get_tiles(self):
-        """Return a list of available tiles."""
-        tiles = list(self.tiles.find({}, {"_id": 0}))
+    def get_tiles(self, fields=None):
+        """Return a list of available tiles (only the given fields, if any)."""
+        tiles = list(self.tiles.find({}, field_projection(fields, "tile_id")))
         return sorted(tiles, key=lambda x: x["tile_id"])
 
     def insert_tile(self, tile_obj):
         """Add a new tile to the database."""
-        self.tiles.insert_one(tile_obj)
+        self.insert_tiles([tile_obj])
+
+    def insert_tiles(self, tile_objs):
+        """Bulk insert tiles; existing tile_ids are skipped, the rest inserted."""
+        if len(tile_objs) == 0:
+            return
+        for tile_obj in tile_objs:
+            tile_obj.setdefault("map_id", tile_map_id(tile_obj["tile_id"]))
+            tile_obj.setdefault("location", document_location(tile_obj))
+        try:
+            self.tiles.insert_many(tile_objs, ordered=False)
+        except BulkWriteError as error:
+            self.mark_stale("tile")  # the other tiles were inserted regardless
+            write_errors = error.details["writeErrors"]
+            if any(e["code"] != 11000 for e in write_errors):
+                raise
+            print(f"> Skipped {len(write_errors)} existing tiles.")
+            return
+        self.mark_stale("tile")
+
+    def add_listener(self, callback):
+        """Register callback(latlons), called whenever ground truth changes."""
+        self.listeners.append(callback)
+
+    def notify(self, latlons):
+        """Tell listeners which locations had their ground truth changed."""
+        if len(latlons) == 0:
+            return
+        for callback in self.listeners:
+            callback(latlons)
+
+    def truth_locations(self, query):
+        """Return the lat/lon of all ground truth matching the query."""
+        projection = {"_id": 0, "latlon": 1}
+        return [t["latlon"] for t in self.ground_truths.find(query, projection)]
 
     def get_targets(self):
         """Return annotation targets."""
@@ -219,14 +414,25 @@ class Database:
         """Return specified target (target_id is scientific name)."""
         return self.targets.find_one({"scientific_name": target_id})
 
+    def add_target(self, target):
+        """Insert a new target (truths carrying its codes now match it)."""
+        self.targets.insert_one(target)
+        self.notify(self.truth_locations({"code": {"$in": target["codes"]}}))
+
     def update_target(self, target):
         """Update the target."""
         target_ = self.targets.find_one({"scientific_name": target["scientific_name"]})
         self.targets.update_one({"_id": target_["_id"]}, {"$set": target}, upsert=False)
+        codes = set(target_["codes"]) | set(target.get("codes", []))
+        self.notify(self.truth_locations({"code": {"$in": list(codes)}}))
 
     def delete_target(self, target_id):
-        """Delete the specified target."""
-        self.targets.delete_one({"target_id": target_id})
+        """Delete the specified target (target_id is scientific name)."""
+        target = self.targets.find_one({"scientific_name": target_id})
+        if target is None:
+            return
+        self.targets.delete_one({"_id": target["_id"]})
+        self.notify(self.truth_locations({"code": {"$in": target["codes"]}}))
 
     def get_maps(self, return_id=False):
         """Return list of maps."""
@@ -246,25 +452,52 @@ class Database:
         """Update the specified map object."""
         self.maps.update_one({"_id": map_obj["_id"]}, {"$set": map_obj}, upsert=False)
 
-    def get_images(self):
-        """Return a list of all images."""
-        images = list(self.imagery.find({}, {"_id": 0}))
+    def get_images(self, fields=None):
+        """Return a list of all images (only the given fields, if any)."""
+        images = list(self.imagery.find({}, field_projection(fields, "image_id")))
         images = sorted(images, key=lambda x: x["image_id"])
         return images
 
     def get_image_locations(self):
         """Get image locations from the database."""
-        image_locations = list(self.imagery.find({}, {"image_id", "lat", "lon"}))
-        image_locations = sorted(image_locations, key=lambda x: x["image_id"])
-        return image_locations
+        return self.get_images(fields=["lat", "lon"])
 
     def get_image(self, image_id):
         """Return specified image object."""
         return self.imagery.find_one({"image_id": image_id}, {"_id": 0})
 
-    def get_ground_truths(self):
-        """Return all available ground truth."""
-        truths = list(self.ground_truths.find({}, {"_id": 0}))
+    def insert_image(self, image_obj):
+        """Add a new image to the database."""
+        image_obj.setdefault("location", document_location(image_obj))
+        self.imagery.insert_one(image_obj)
+        self.mark_stale("image")
+
+    def build_image_neighbors(self, map_id):
+        """Store the nearest image in each direction on every image of a map."""
+        projection = {"_id": 0, "image_id": 1, "lat": 1, "lon": 1}
+        images = list(self.imagery.find({"map_id": map_id}, projection))
+        if len(images) == 0:
+            return
+        lat = np.array([img["lat"] for img in images])
+        lon = np.array([img["lon"] for img in images])
+        neighbors = directional_neighbors(lat, lon)
+        updates = []
+        for itr, img in enumerate(images):
+            image_neighbors = {}
+            for direction in DIRECTIONS:
+                idx = neighbors[direction][itr]
+                if idx >= 0:
+                    image_neighbors[direction] = images[idx]["image_id"]
+                else:
+                    image_neighbors[direction] = None
+            update = {"$set": {"neighbors": image_neighbors}}
+            updates.append(UpdateOne({"image_id": img["image_id"]}, update))
+        self.imagery.bulk_write(updates, ordered=False)
+
+    def get_ground_truths(self, fields=None):
+        """Return all available ground truth (only the given fields, if any)."""
+        projection = field_projection(fields, "datetime")
+        truths = list(self.ground_truths.find({}, projection))
         truths = sorted(truths, key=lambda x: x["datetime"])
         return truths
 
@@ -273,18 +506,24 @@ class Database:
         return list(self.ground_truths.find_one({"ground_truth_id": ground_truth_id}))
 
     def add_ground_truth(self, truth):
+        truth.setdefault("location", document_location(truth))
         self.ground_truths.insert_one(truth)
-        self.build_truth_tree()  # now more truths around, so rebuild
+        self.mark_stale("truth")
+        self.notify([truth["latlon"]])
 
     def delete_ground_truth_for_image(self, image_id):
         """Delete all manual ground truth on specified tile."""
+        latlons = self.truth_locations({"image_id": image_id})
         self.ground_truths.delete_many({"image_id": image_id})
-        self.build_truth_tree()  # because there's missing data
+        self.mark_stale("truth")
+        self.notify(latlons)
 
     def delete_ground_truth_for_tile(self, tile_id):
         """Delete all manual ground truth on specified tile."""
+        latlons = self.truth_locations({"tile_id": tile_id})
         self.ground_truths.delete_many({"tile_id": tile_id})
-        self.build_truth_tree()  # because there's missing data
+        self.mark_stale("truth")
+        self.notify(latlons)
 
     def get_annotation(self, annotation_id):
         """Find specified annotation."""
@@ -326,37 +565,250 @@ class Database:
         except:
             print("> Sorry, that point is already annotated.")
 
+    def apply_annotation_operations(self, operations):
+        """Apply many annotation creates/deletes in a single unordered bulk write."""
+        requests, request_idx, results, delete_ids = plan_annotation_writes(operations)
+        existing = {
+            a["annotation_id"]: a
+            for a in self.annotations.find(
+                {"annotation_id": {"$in": delete_ids}}, {"_id": 0}
+            )
+        }
+        errors = {}
+        if len(requests) > 0:
+            try:
+                self.annotations.bulk_write(requests, ordered=False)
+            except BulkWriteError as error:
+                errors = {e["index"]: e for e in error.details["writeErrors"]}
+        query = {"annotation_id": {"$in": list(existing)}}
+        projection = {"_id": 0, "annotation_id": 1}
+        remaining = {
+            a["annotation_id"] for a in self.annotations.find(query, projection)
+        }
+        return summarize_annotation_writes(
+            operations, request_idx, results, errors, existing, remaining
+        )
+
     def update_annotation(self, data):
         """Update an existing annotation."""
         self.annotations.update_one({"_id": data["_id"]}, {"$set": data}, upsert=False)
 
-    def build_image_tree(self):
-        """Compute a BallTree object for images in the database."""
-        images = self.get_image_locations()
-        if len(images) > 0:
-            image_locations = np.array([[img["lat"], img["lon"]] for img in images])
-            self.image_tree = BallTree(image_locations)
-        else:
-            self.image_tree = None
-
-    def build_tile_tree(self):
-        """Build a BallTree for organizing the tiles in space."""
-        tiles = self.get_tiles()
-        tile_locations = np.array(
-            [
-                [(t["north"] + t["south"]) / 2, (t["east"] + t["west"]) / 2]
-                for t in tiles
-            ]
+    def ensure_indexes(self):
+        """Create the declared indexes and drop the ones they supersede."""
+        for name, indexes in INDEXES.items():
+            for keys, options in indexes:
+                self.db[name].create_index(keys, **options)
+        for name, index_names in REDUNDANT_INDEXES.items():
+            existing = self.db[name].index_information()
+            for index_name in index_names:
+                if index_name in existing:
+                    self.db[name].drop_index(index_name)
+                    print(f"> Dropped redundant index {name}.{index_name}.")
+
+    def find_in_order(self, collection, key, values, query=None):
+        """Documents whose key is in values, in the order of values."""
+        query = dict(query or {})
+        query[key] = {"$in": values}
+        docs = collection.find(query, {"_id": 0, "location": 0})
+        docs = {doc[key]: doc for doc in docs}
+        return [docs[value] for value in values if value in docs]
+
+    def ensure_geo_indexes(self):
+        """Create the 2dsphere indexes used by the mongo spatial backend."""
+        geo_index = [("location", pymongo.GEOSPHERE), ("map_id", pymongo.ASCENDING)]
+        self.imagery.create_index(geo_index)
+        self.tiles.create_index(geo_index)
+        self.ground_truths.create_index([("location", pymongo.GEOSPHERE)])
+
+    def add_locations(self):
+        """Store GeoJSON locations (and tile map_ids) on documents lacking them."""
+        for collection in [self.imagery, self.tiles, self.ground_truths]:
+            updates = []
+            for doc in collection.find({"location": {"$exists": False}}):
+                update = {"location": document_location(doc)}
+                if collection is self.tiles:
+                    update["map_id"] = tile_map_id(doc["tile_id"])
+                updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+            if len(updates) > 0:
+                collection.bulk_write(updates, ordered=False)
+            print(f"> Added locations to {len(updates)} {collection.name} documents.")
+
+    def near(self, collection, lat, lon, limit, query=None):
+        """Documents ordered by distance from lat/lon, via the 2dsphere index."""
+        query = dict(query or {})
+        query["location"] = {"$near": {"$geometry": geo_point(lat, lon)}}
+        projection = {"_id": 0, "location": 0}
+        return list(collection.find(query, projection).limit(limit))
+
+    def truths_near(self, lat, lon, limit=300):
+        """Ground truth ordered by distance from lat/lon (closest first)."""
+        if not self.use_trees:
+            return self.near(self.ground_truths, lat, lon, limit)
+        index = self.spatial_index("truth")
+        if index["tree"] is None:
+            return []
+        with timer("balltree"):
+            k = min(limit, len(index["ids"]))
+            _, idx = index["tree"].query([[lat, lon]], k=k)
+        ids = [index["ids"][i] for i in idx[0]]
+        truths = self.ground_truths.find({"_id": {"$in": ids}}, {"location": 0})
+        truths = {truth.pop("_id"): truth for truth in truths}
+        return [truths[_id] for _id in ids if _id in truths]
+
+    def images_near(self, lat, lon, map_id, limit=1000):
+        """Images of a map ordered by distance from lat/lon.
+
+        With the BallTree backend, only the map's images among the limit nearest
+        overall are returned.
+        """
+        if not self.use_trees:
+            return self.near(self.imagery, lat, lon, limit, {"map_id": map_id})
+        index = self.spatial_index("image")
+        if index["tree"] is None:
+            return []
+        with timer("balltree"):
+            k = min(limit, len(index["ids"]))
+            _, idx = index["tree"].query([[lat, lon]], k=k)
+        ids = [index["ids"][i] for i in idx[0]]
+        return self.find_in_order(self.imagery, "image_id", ids, {"map_id": map_id})
+
+    def tiles_near(self, lat, lon, map_id, limit=100):
+        """Tiles of a map ordered by distance (of their centers) from lat/lon."""
+        if not self.use_trees:
+            return self.near(self.tiles, lat, lon, limit, {"map_id": map_id})
+        index = self.spatial_index("tile")
+        if index["tree"] is None:
+            return []
+        with timer("balltree"):
+            k = min(limit, len(index["ids"]))
+            _, idx = index["tree"].query([[lat, lon]], k=k)
+        ids = [index["ids"][i] for i in idx[0]]
+        ids = [tile_id for tile_id in ids if tile_map_id(tile_id) == map_id]
+        return self.find_in_order(self.tiles, "tile_id", ids)
+
+    def spatial_index(self, kind):
+        """The ids and BallTree for a kind of document, loaded or built on first use."""
+        with self.tree_lock:
+            if kind not in self.spatial_indexes:
+                self.spatial_indexes[kind] = self.load_or_build_index(kind)
+            return self.spatial_indexes[kind]
+
+    @property
+    def image_tree(self):
+        """BallTree over image positions."""
+        return self.spatial_index("image")["tree"]
+
+    @property
+    def tile_tree(self):
+        """BallTree over tile centers."""
+        return self.spatial_index("tile")["tree"]
+
+    @property
+    def truth_tree(self):
+        """BallTree over ground truth positions."""
+        return self.spatial_index("truth")["tree"]
+
+    def mark_stale(self, kind):
+        """Note a write to the documents of a spatial index; rebuilt on next use."""
+        collection = SPATIAL_INDEXES[kind]
+        self.db.versions.update_one(
+            {"_id": collection}, {"$inc": {"version": 1}}, upsert=True
         )
-        if len(tile_locations) > 0:
-            self.tile_tree = BallTree(tile_locations)
+        with self.tree_lock:
+            self.spatial_indexes.pop(kind, None)
+
+    def collection_version(self, collection):
+        """Identify the current contents of a collection, for keying cached trees."""
+        counter = self.db.versions.find_one({"_id": collection.name}) or {}
+        last = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        last_id = last["_id"] if last is not None else None
+        count = collection.estimated_document_count()
+        return f"{counter.get('version', 0)}-{count}-{last_id}"
+
+    def load_or_build_index(self, kind):
+        """Load the spatial index from the tree cache, or build (and cache) it."""
+        collection = self.db[SPATIAL_INDEXES[kind]]
+        path = None
+        if TREE_CACHE:
+            version = self.collection_version(collection)
+            digest = hashlib.sha1(version.encode()).hexdigest()[:16]
+            path = f"{TREE_CACHE_LOCATION}/{kind}-{digest}.pkl"
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        return pickle.load(f)
+                except Exception:  # truncated, or from another sklearn version
+                    print(f"> Could not load {path}; rebuilding.")
+        from sklearn.neighbors import BallTree
+
+        ids, positions = getattr(self, f"{kind}_positions")()
+        index = {"ids": ids, "tree": BallTree(positions) if len(ids) > 0 else None}
+        if path is not None:
+            os.makedirs(TREE_CACHE_LOCATION, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)  # atomic, for concurrent readers
+            self.prune_tree_cache(kind, keep=path)
+        return index
+
+    def prune_tree_cache(self, kind, keep):
+        """Remove cached trees of other versions, older than the one just written.
+
+        Other processes may be rebuilding or pruning at the same time, so files
+        that are already gone are skipped, and newer pickles are left alone.
+        """
+        try:
+            keep_time = os.path.getmtime(keep)
+        except FileNotFoundError:  # already replaced by a newer version
+            return
+        for old_path in glob(f"{TREE_CACHE_LOCATION}/{kind}-*.pkl"):
+            if old_path == keep:
+                continue
+            try:
+                if os.path.getmtime(old_path) < keep_time:
+                    os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    def image_positions(self):
+        """Image ids and their lat/lon."""
+        images = self.get_image_locations()
+        ids = [img["image_id"] for img in images]
+        return ids, np.array([[img["lat"], img["lon"]] for img in images])
+
+    def tile_positions(self):
+        """Tile ids and the lat/lon of their centers."""
+        tiles = self.get_tiles(fields=["north", "south", "east", "west"])
+        ids = [t["tile_id"] for t in tiles]
+        positions = [
+            [(t["north"] + t["south"]) / 2, (t["east"] + t["west"]) / 2] for t in tiles
+        ]
+        return ids, np.array(positions)
+
+    def truth_positions(self):
+        """Ground truth _ids and their lat/lon."""
+        truths = self.get_ground_truths(fields=["_id", "latlon"])
+        ids = [t["_id"] for t in truths]
+        return ids, np.array([[t["latlon"][0], t["latlon"][1]] for t in truths])
+
+
+class LazyDatabase:
+    """Stand-in for the global Database that connects on first use."""
+
+    def __init__(self):
+        """Nothing is connected (or indexed) until an attribute is needed."""
+        self._database = None
+        self._lock = threading.Lock()
 
-    def build_truth_tree(self):
-        """Compute a BallTree object for all ground truth in the database."""
-        truths = self.get_ground_truths()
-        truth_locations = np.array([[t["latlon"][0], t["latlon"][1]] for t in truths])
-        self.truth_tree = BallTree(truth_locations)
+    def __getattr__(self, name):
+        """Create the Database on first access, then delegate to it."""
+        if self._database is None:
+            with self._lock:
+                if self._database is None:
+                    self._database = Database()
+        return getattr(self._database, name)
 
 
-# Create the global database!
-db = Database()
+# Create the global database (it connects when first used).
+db = LazyDatabase()
@@ -0,0 +1,171 @@
+"""Columnar store of CNN detections for one map and one species.
+
+Scans of all images of a map live in a directory of flat float32 columns:
+
+    prob.f32      probability of the target, one per scanned position
+    image_ab.f32  (alpha, beta) of the position within its image
+    map_ab.f32    (alpha, beta) of the position within the map (map_boundaries)
+    index.json    image_ids, and offsets so that the rows of image_ids[i] are
+                  offsets[i]:offsets[i + 1]
+
+Columns are appended image by image and read back as read-only memmaps, so
+thresholding or slicing a map never builds Python lists of floats.
+"""
+from config import ARGOS_ROOT
+
+import json
+import numpy as np
+import os
+
+
+DETECTION_STORE_LOCATION = f"{ARGOS_ROOT}/detections"
+COLUMNS = {"prob": 1, "image_ab": 2, "map_ab": 2}  # name -> values per row
+
+
+def map_positions(image_ab, image_model, map_model):
+    """Project (alpha, beta) positions in an image onto the full map."""
+    image_ab = np.asarray(image_ab, dtype=np.float64).reshape(-1, 2)
+    lat, lon = image_model.to_lat_lon(image_ab[:, 0], image_ab[:, 1])
+    alpha, beta = map_model.to_alpha_beta(lat, lon, boundaries_to_use="map_boundaries")
+    return np.column_stack([alpha, beta])
+
+
+class DetectionStore:
+    """Append-only detections of one species over one map."""
+
+    def __init__(self, map_id, model_name, location=DETECTION_STORE_LOCATION):
+        """Open (or prepare) the store; nothing is created until the first append."""
+        self.map_id = map_id
+        self.model_name = model_name
+        self.path = f"{location}/{map_id}_{model_name}"
+        self.columns = {}  # open memmaps, dropped whenever rows are added
+        self.load_index()
+
+    def load_index(self):
+        """Read the image table from disk."""
+        index_file = f"{self.path}/index.json"
+        index = {"image_ids": [], "offsets": [0]}
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+        self.image_ids = index["image_ids"]
+        self.offsets = np.array(index["offsets"], dtype=np.int64)
+        self.rows = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        self.columns = {}
+
+    def save_index(self):
+        """Write the image table atomically (the columns are already on disk)."""
+        index_file = f"{self.path}/index.json"
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {"image_ids": self.image_ids, "offsets": self.offsets.tolist()}, f
+            )
+        os.replace(tmp_file, index_file)
+
+    def __len__(self):
+        """Number of detections (scanned positions) in the store."""
+        return int(self.offsets[-1])
+
+    def __contains__(self, image_id):
+        """Has this image been added?"""
+        return image_id in self.rows
+
+    def append(self, image_id, prob, image_ab, map_ab):
+        """Add the scan of one image; returns False if it is already stored."""
+        if image_id in self:
+            return False
+        values = {
+            "prob": np.asarray(prob, dtype=np.float32).reshape(-1),
+            "image_ab": np.asarray(image_ab, dtype=np.float32).reshape(-1, 2),
+            "map_ab": np.asarray(map_ab, dtype=np.float32).reshape(-1, 2),
+        }
+        nb_rows = len(values["prob"])
+        if any(len(column) != nb_rows for column in values.values()):
+            raise ValueError(f"Columns of {image_id} differ in length.")
+        os.makedirs(self.path, exist_ok=True)
+        for name, width in COLUMNS.items():
+            with open(f"{self.path}/{name}.f32", "ab") as f:
+                # Drop rows of an append that was interrupted before its index
+                # was saved; those rows are not referenced by the offsets.
+                f.truncate(len(self) * width * 4)
+                f.write(values[name].tobytes())
+        self.image_ids.append(image_id)
+        self.rows[image_id] = len(self.image_ids) - 1
+        self.offsets = np.append(self.offsets, len(self) + nb_rows)
+        self.columns = {}
+        self.save_index()
+        return True
+
+    def column(self, name):
+        """Read-only memmap of a column (rows beyond the index are ignored)."""
+        if name not in self.columns:
+            width = COLUMNS[name]
+            shape = (len(self),) if width == 1 else (len(self), width)
+            if len(self) == 0:
+                self.columns[name] = np.zeros(shape, dtype=np.float32)
+            else:
+                self.columns[name] = np.memmap(
+                    f"{self.path}/{name}.f32", dtype=np.float32, mode="r", shape=shape
+                )
+        return self.columns[name]
+
+    @property
+    def prob(self):
+        """Probability per detection."""
+        return self.column("prob")
+
+    @property
+    def image_ab(self):
+        """Position of each detection within its image."""
+        return self.column("image_ab")
+
+    @property
+    def map_ab(self):
+        """Position of each detection within the map."""
+        return self.column("map_ab")
+
+    def image_slice(self, image_id):
+        """Rows belonging to an image."""
+        i = self.rows[image_id]
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def image(self, image_id):
+        """All columns for one image (views into the memmaps)."""
+        rows = self.image_slice(image_id)
+        return {name: self.column(name)[rows] for name in COLUMNS}
+
+    def image_numbers(self):
+        """Index into image_ids of the image each row belongs to."""
+        return np.repeat(np.arange(len(self.image_ids)), np.diff(self.offsets))
+
+    def above(self, threshold, chunk_size=1 << 22):
+        """Indices of detections with probability above threshold."""
+        prob = self.prob
+        chunks = [
+            start + np.flatnonzero(prob[start : start + chunk_size] > threshold)
+            for start in range(0, len(prob), chunk_size)
+        ]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+    def select(self, threshold):
+        """All columns (as arrays) for detections above threshold."""
+        idx = self.above(threshold)
+        return {name: self.column(name)[idx] for name in COLUMNS}
+
+    def import_vessel(self, vessel, project=None):
+        """Copy a map scan saved by the old map_maker (a Vessel) into the store.
+
+        Images without map_alpha_beta are projected with project(image_dict).
+        """
+        nb_added = 0
+        for image_id, image_dict in vessel.images.items():
+            if "map_alpha_beta" in image_dict:
+                map_ab = image_dict["map_alpha_beta"]
+            else:
+                map_ab = project(image_dict)
+            image_id = image_dict.get("image_id", image_id)
+            prob, image_ab = image_dict["prob"], image_dict["X"]
+            nb_added += self.append(image_id, prob, image_ab, map_ab)
+        print(f"> Imported {nb_added} images into {self.path}.")
+        return self
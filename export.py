@@ -1,6 +1,6 @@
 """Tools for importing and exporting data from MongoDB."""
-from database import *
-from vessel import *
+from database import db
+from vessel import Vessel
 
 
 def export_data(path_to_export_file):
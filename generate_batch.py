@@ -1,5 +1,6 @@
 """Generate a batch of training data (in a separate process, usually)."""
-from database import *
+from database import smart_batch
+from vessel import Vessel
 
 import argparse
 
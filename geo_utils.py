@@ -1,15 +1,21 @@
 """Utilities for working with geo-rectified imagery."""
-from vessel import Vessel
+from metrics import timed
 
-from exiftool import ExifTool
-import geomag
-from geopy.distance import distance
-from ipdb import set_trace as debug
 import numpy as np
 
 
+DIRECTIONS = ["north", "south", "east", "west"]
+
+
+def geo_point(lat, lon):
+    """GeoJSON point for MongoDB (GeoJSON puts longitude first)."""
+    return {"type": "Point", "coordinates": [float(lon), float(lat)]}
+
+
 def distance_on_earth(a, b):
     """Find the distance (in meters) between two points on the Earth."""
+    from geopy.distance import distance
+
     return distance(a, b).meters
 
 
@@ -34,6 +40,8 @@ def calculate_image_radius_in_meters(exif_obj):
 
 def unit_vectors(exif_obj):
     """Compute east and north unit vectors given the camera yaw."""
+    import geomag
+
     camera_yaw = exif_obj["camera_yaw"]
     lat, lon = exif_obj["img_lat"], exif_obj["img_lon"]
     declination = geomag.declination(lat, lon)
@@ -44,8 +52,70 @@ def unit_vectors(exif_obj):
     return np.array(n), np.array(e)
 
 
+def directional_neighbors(lat, lon, block_size=512):
+    """Index of the nearest point to the north/south/east/west of each point.
+
+    A neighbour must lie within the 90 degree cone around the direction; if the
+    cone is empty (e.g., at the edge of a flight) the half-plane is used
+    instead. Returns a dict of index arrays, with -1 where no neighbour exists.
+    """
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    nb_points = len(lat)
+    lon_scale = np.cos(np.radians(lat.mean()))  # makes degrees locally isotropic
+    neighbors = {d: -np.ones(nb_points, dtype=int) for d in DIRECTIONS}
+    # Work in blocks of rows to bound the size of the pairwise matrices.
+    for start in range(0, nb_points, block_size):
+        stop = min(start + block_size, nb_points)
+        dy = lat[None, :] - lat[start:stop, None]  # [i, j]: offset of j from i
+        dx = (lon[None, :] - lon[start:stop, None]) * lon_scale
+        dist = np.hypot(dx, dy)
+        dist[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        along = {"north": dy, "south": -dy, "east": dx, "west": -dx}
+        across = {"north": dx, "south": dx, "east": dy, "west": dy}
+        rows = np.arange(stop - start)
+        for direction in DIRECTIONS:
+            in_half = along[direction] > 0
+            in_cone = in_half & (along[direction] >= np.abs(across[direction]))
+            for mask in (in_cone, in_half):
+                d = np.where(mask, dist, np.inf)
+                idx = d.argmin(axis=1)
+                found = np.isfinite(d[rows, idx])
+                missing = neighbors[direction][start:stop] < 0
+                neighbors[direction][start:stop][found & missing] = idx[found & missing]
+    return neighbors
+
+
+def tile_to_lat_lon_bounds(z, x, y):
+    """Return (north, south, west, east) of a web-mercator (XYZ) tile."""
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return north, south, west, east
+
+
+def tile_row_latitudes(z, y, tile_size=256):
+    """Latitude at the center of each pixel row of a web-mercator tile."""
+    n = 2 ** z
+    y_ = y + (np.arange(tile_size) + 0.5) / tile_size
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y_ / n))))
+
+
+def lat_lon_to_tile(lat, lon, z):
+    """Return the (x, y) web-mercator tile containing the given point."""
+    n = 2 ** z
+    lat_rad = np.radians(lat)
+    x = int(np.floor((lon + 180) / 360 * n))
+    y = int(np.floor((1 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+@timed("exiftool")
 def extract_info(image_file):
     """Extract necessary data from metadata dictionary."""
+    from exiftool import ExifTool
+
     image_file = image_file.replace("'", "")
     with ExifTool() as et:
         metadata = et.get_metadata(image_file)
@@ -90,7 +160,7 @@ def pixel_to_lat_lon(row, col, image_file=None, exif_info=None):
 
 
 def alpha_beta_to_lat_lon(alpha, beta, image_file=None, exif_info=None):
-    """Convert given pixel position to lat/lon."""
+    """Convert given pixel position (or arrays of positions) to lat/lon."""
     if exif_info:
         d = exif_info
     else:
@@ -104,9 +174,9 @@ def alpha_beta_to_lat_lon(alpha, beta, image_file=None, exif_info=None):
     # Compute the unit vectors in the north and east directions.
     # Find dispacement in those directions, given specfied latitude/longitude.
     n, e = unit_vectors(d)
-    pixel_vector = np.array([row - d["img_height"] / 2, col - d["img_width"] / 2])
-    dn_in_meters = np.dot(pixel_vector, n) * meters_per_pixel
-    de_in_meters = np.dot(pixel_vector, e) * meters_per_pixel
+    drow, dcol = row - d["img_height"] / 2, col - d["img_width"] / 2
+    dn_in_meters = (drow * n[0] + dcol * n[1]) * meters_per_pixel
+    de_in_meters = (drow * e[0] + dcol * e[1]) * meters_per_pixel
 
     pos = np.array([d["img_lat"], d["img_lon"]])
     meters_per_degree_lat = distance_on_earth(pos, pos + [1, 0])
@@ -120,7 +190,7 @@ def alpha_beta_to_lat_lon(alpha, beta, image_file=None, exif_info=None):
 
 
 def lat_lon_to_alpha_beta(lat, lon, image_file=None, exif_info=None):
-    """Convert from lat/lon to unit position within the image."""
+    """Convert from lat/lon (or arrays of them) to unit position within the image."""
     if exif_info:
         d = exif_info
     else:
@@ -143,10 +213,10 @@ def lat_lon_to_alpha_beta(lat, lon, image_file=None, exif_info=None):
     de_in_pixels = de_in_meters / meters_per_pixel
 
     # Projected position is location relative to center of image.
-    ctr_position = np.array([d["img_height"] / 2, d["img_width"] / 2])
-    target_position = ctr_position + (dn_in_pixels * n + de_in_pixels * e)
-    alpha = target_position[0] / d["img_height"]
-    beta = target_position[1] / d["img_width"]
+    row = d["img_height"] / 2 + dn_in_pixels * n[0] + de_in_pixels * e[0]
+    col = d["img_width"] / 2 + dn_in_pixels * n[1] + de_in_pixels * e[1]
+    alpha = row / d["img_height"]
+    beta = col / d["img_width"]
     return alpha, beta
 
 
@@ -187,8 +257,9 @@ def in_image(location, image_file: str):
 
 
 if __name__ == "__main__":
-    from database import *
-    from models import *
+    from database import db
+    from models import MapModel
+    from utils import prepend_argos_root
     from glob import glob
     import pylab as plt
 
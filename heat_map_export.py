@@ -0,0 +1,223 @@
+"""Render heat map overlays without matplotlib: GeoTIFF, PNG and KML per result.
+
+Densities (density.py) or probability mosaics (mosaic.py) are colour mapped
+with a numpy lookup table and written as a tiled, georeferenced RGBA GeoTIFF
+(with overviews), plus a PNG and a KML GroundOverlay for Google Earth. Every
+(map, species) detection store can be rendered in one go on the scan server:
+
+    python heat_map_export.py --workers 4
+    python heat_map_export.py --map-id 2018-06-27-elberta_site_1-66 --source mosaic
+"""
+from config import ARGOS_ROOT, EPSG
+from density import store_density
+from detection_store import DETECTION_STORE_LOCATION, DetectionStore
+from mosaic import ProbabilityMosaic, mosaic_shape
+from utils import prepend_argos_root
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+import numpy as np
+import os
+
+
+HEAT_MAP_LOCATION = f"{ARGOS_ROOT}/heat_maps"
+BLOCK_SIZE = 256  # internal tile size of the GeoTIFFs
+
+# Colour stops (position, RGB) of the default colour map, dark purple to yellow.
+PLASMA = [
+    (0.0, (13, 8, 135)),
+    (0.25, (126, 3, 168)),
+    (0.5, (204, 71, 120)),
+    (0.75, (248, 149, 64)),
+    (1.0, (240, 249, 33)),
+]
+
+KML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <GroundOverlay>
+    <name>{name}</name>
+    <Icon><href>{href}</href></Icon>
+    <LatLonBox>
+      <north>{north}</north>
+      <south>{south}</south>
+      <east>{east}</east>
+      <west>{west}</west>
+    </LatLonBox>
+  </GroundOverlay>
+</kml>
+"""
+
+
+def colormap_lut(stops=PLASMA, n=256):
+    """(n, 3) uint8 lookup table interpolated between colour stops."""
+    positions = [position for position, _ in stops]
+    colors = np.array([color for _, color in stops], dtype=np.float64)
+    x = np.linspace(0, 1, n)
+    lut = [np.interp(x, positions, colors[:, k]) for k in range(3)]
+    return np.round(np.column_stack(lut)).astype(np.uint8)
+
+
+def colorize(values, lut=None, vmax=None, gain=10, midpoint=0.25):
+    """RGBA overlay of values; opacity rises smoothly with the value (NaN is clear).
+
+    The opacity curve is the one transparent_cmap gives the matplotlib heat maps.
+    """
+    lut = colormap_lut() if lut is None else lut
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    vmax = vmax or (values[valid].max() if valid.any() else 1.0) or 1.0
+    scaled = np.clip(np.where(valid, values, 0) / vmax, 0, 1)
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = lut[np.round(scaled * (len(lut) - 1)).astype(int)]
+    opacity = 1 / (1 + np.exp(-gain * (scaled - midpoint)))
+    rgba[..., 3] = np.where(valid, np.round(255 * opacity), 0)
+    return rgba
+
+
+def map_boundaries(map_dict):
+    """Lat/lon boundaries of the full map (read from its KML if not stored)."""
+    if "map_boundaries" in map_dict:
+        return map_dict["map_boundaries"]
+    from read_kml import parse_keyhole
+
+    return parse_keyhole(prepend_argos_root(map_dict["path_to_map_kml"]))
+
+
+def write_geotiff(path, rgba, boundaries, block_size=BLOCK_SIZE):
+    """Write an RGBA overlay as a tiled, compressed GeoTIFF with overviews."""
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_bounds
+
+    height, width, _ = rgba.shape
+    bnd = boundaries
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 4,
+        "dtype": "uint8",
+        "crs": f"EPSG:{EPSG}",
+        "transform": from_bounds(
+            bnd["west"], bnd["south"], bnd["east"], bnd["north"], width, height
+        ),
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "deflate",
+        "photometric": "RGB",
+        "alpha": "unassociated",
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        dst.write(np.moveaxis(rgba, -1, 0))
+        factors = [2 ** k for k in range(1, 8) if max(height, width) >> k >= block_size]
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
+    os.replace(tmp_path, path)
+
+
+def write_kml(path, name, href, boundaries):
+    """Write a KML GroundOverlay placing the image href over the boundaries."""
+    bnd = boundaries
+    with open(path, "w") as f:
+        f.write(
+            KML_TEMPLATE.format(
+                name=name,
+                href=href,
+                north=bnd["north"],
+                south=bnd["south"],
+                east=bnd["east"],
+                west=bnd["west"],
+            )
+        )
+
+
+def render_overlay(values, boundaries, name, out_dir=HEAT_MAP_LOCATION, vmax=None):
+    """Write <name>.tif, <name>.png and <name>.kml for an array over the boundaries."""
+    from PIL import Image
+
+    os.makedirs(out_dir, exist_ok=True)
+    rgba = colorize(values, vmax=vmax)
+    write_geotiff(f"{out_dir}/{name}.tif", rgba, boundaries)
+    Image.fromarray(rgba, "RGBA").save(f"{out_dir}/{name}.png")
+    write_kml(f"{out_dir}/{name}.kml", name, f"{name}.png", boundaries)
+    return f"{out_dir}/{name}.tif"
+
+
+def render_result(
+    map_dict,
+    model_name,
+    source="density",
+    bandwidth=8,
+    resolution=2048,
+    threshold=0.999,
+    out_dir=HEAT_MAP_LOCATION,
+):
+    """Render the heat map of one (map, species) scan; returns the GeoTIFF path."""
+    map_id = map_dict["map_id"]
+    boundaries = map_boundaries(map_dict)
+    if source == "mosaic":
+        mosaic = ProbabilityMosaic(map_id, model_name, mode="r")
+        values, boundaries = mosaic.mean(), mosaic.boundaries
+    else:
+        store = DetectionStore(map_id, model_name)
+        shape = mosaic_shape(boundaries, resolution)
+        values = store_density(store, shape, [bandwidth], threshold)[bandwidth]
+    name = f"{map_id}_{model_name}_{source}"
+    return render_overlay(values, boundaries, name, out_dir)
+
+
+def scan_results(maps, location=DETECTION_STORE_LOCATION):
+    """(map_dict, model_name) for every detection store of the given maps."""
+    results = []
+    for map_dict in maps:
+        prefix = f"{location}/{map_dict['map_id']}_"
+        for index_file in sorted(glob(f"{prefix}*/index.json")):
+            results.append((map_dict, os.path.dirname(index_file)[len(prefix) :]))
+    return results
+
+
+def render_all(results, nb_workers=None, **kwargs):
+    """Render many results in parallel; returns the paths written."""
+    paths = []
+    with ProcessPoolExecutor(max_workers=nb_workers) as pool:
+        futures = [
+            pool.submit(render_result, map_dict, model_name, **kwargs)
+            for map_dict, model_name in results
+        ]
+        for future in as_completed(futures):
+            path = future.result()
+            print(f"> Wrote {path}")
+            paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    from database import db
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--map-id", help="only render this map")
+    parser.add_argument("--source", choices=["density", "mosaic"], default="density")
+    parser.add_argument("--bandwidth", type=float, default=8, help="in grid cells")
+    parser.add_argument("--resolution", type=int, default=2048)
+    parser.add_argument("--threshold", type=float, default=0.999)
+    parser.add_argument("--out", default=HEAT_MAP_LOCATION)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    maps = db.get_maps()
+    if args.map_id:
+        maps = [m for m in maps if m["map_id"] == args.map_id]
+    results = scan_results(maps)
+    print(f"> Rendering {len(results)} heat maps.")
+    render_all(
+        results,
+        nb_workers=args.workers,
+        source=args.source,
+        bandwidth=args.bandwidth,
+        resolution=args.resolution,
+        threshold=args.threshold,
+        out_dir=args.out,
+    )
@@ -1,12 +1,12 @@
 """Generate target density maps for specified map."""
-from database import *
-from models import *
-from stores import *
-from vessel import Vessel
+from database import db
+from density import store_density
+from heat_map_export import HEAT_MAP_LOCATION, map_boundaries, render_overlay
+from models import MapModel
+from stores import elberta_centaurea_06, frangula_07, frangula_08
 
-from fastkde import fastKDE
 import numpy as np
-from skimage.io import imread
+import pylab as plt
 from pylab import ion, close, imshow, figure, show, plot
 from tqdm import tqdm
 
@@ -15,62 +15,56 @@ class HeatMap:
     """Generate density and point maps."""
 
     def __init__(self, map_dict, map_data):
-        """Load map image, extract points."""
+        """Load map image, extract points from the map's DetectionStore."""
         self.map_dict = map_dict
         self.map_data = map_data
         self.extract_points()
-        path_to_map = prepend_argos_root(map_dict["path_to_geomap"])
-        # Load the map image.
-        self.map_image = imread(path_to_map)
-        self.height, self.width, chans = self.map_image.shape
+        self.map_model = MapModel(map_dict)
+        # Only the raster header is needed for the full-resolution shape.
+        self.height, self.width, chans = self.map_model.geomap_shape()
+
+    def load_map_image(self, max_size=4096):
+        """Load a reduced-resolution view of the map (from the pyramid)."""
+        bnd = self.map_dict["map_boundaries"]
+        return self.map_model.read_window(
+            bnd["north"], bnd["south"], bnd["west"], bnd["east"], max_size=max_size
+        )
 
     def extract_points(self):
         """Extract likely target positions from map data."""
-        map_data = self.map_data
-        map_alpha_beta = []
-        probability = []
-        for image_path in map_data.images.keys():
-            image_dict = map_data.images[image_path]
-            map_alpha_beta.extend(image_dict["map_alpha_beta"])
-            probability.extend(image_dict["prob"])
-        probability = np.array(probability)
-        map_alpha_beta = np.array(map_alpha_beta)
-        valid_idx = np.nonzero(probability > 0.999)[0]
+        valid_idx = self.map_data.above(0.999)
         np.random.shuffle(valid_idx)
-        self.map_alpha_beta = map_alpha_beta
+        self.map_alpha_beta = self.map_data.map_ab  # memmap; rows read on demand
         self.valid_idx = valid_idx
 
     def get_points(self, max_number=8000):
         """Return row/col points in map coordinate system."""
-        points = []
-        rows = []
-        cols = []
-        for idx in self.valid_idx[:max_number]:
-            alpha, beta = self.map_alpha_beta[idx]
-            row, col = alpha * self.height, beta * self.width
-            rows.append(row)
-            cols.append(col)
-        return np.array(rows), np.array(cols)
-
-    def plot_density(self, max_number=9000):
+        idx = self.valid_idx[:max_number]
+        alpha_beta = self.map_alpha_beta[np.sort(idx)].astype(np.float64)
+        return alpha_beta[:, 0] * self.height, alpha_beta[:, 1] * self.width
+
+    def density(self, bandwidths=(8,), spacing=2049, threshold=0.999):
+        """Densities of all detections above threshold, per bandwidth (grid cells)."""
+        shape = (spacing, spacing)
+        return store_density(self.map_data, shape, bandwidths, threshold)
+
+    def export(self, name, bandwidth=8, spacing=2049, out_dir=HEAT_MAP_LOCATION):
+        """Write the density as a georeferenced GeoTIFF/PNG/KML (no matplotlib)."""
+        pdf = self.density([bandwidth], spacing)[bandwidth]
+        return render_overlay(pdf, map_boundaries(self.map_dict), name, out_dir)
+
+    def plot_density(self, bandwidth=8, spacing=2049, threshold=0.999):
         """Plot the density using kernel densty estimates (KDEs)."""
-        spacing = 2049
         # Use base cmap to create transparent.
         mycmap = transparent_cmap(plt.cm.plasma)
         mycmap = transparent_cmap(plt.cm.gnuplot)
         # mycmap = transparent_cmap(plt.cm.bone)
 
-        # Make a grid to sample on (randomized a little bit).
-        rows, cols = self.get_points(max_number=max_number)
-        grid_rows = np.linspace(
-            0, self.height, spacing
-        )  # + 10 * (np.random.rand(512) - 0.5)
-        grid_cols = np.linspace(
-            0, self.width, spacing
-        )  # + 10 * (np.random.rand(512) - 0.5)
+        # Bin every detection onto the grid and smooth it (FFT convolution).
+        grid_rows = np.linspace(0, self.height, spacing)
+        grid_cols = np.linspace(0, self.width, spacing)
         axes = np.array([grid_cols, grid_rows])
-        pdf, axes = fastKDE.pdf(cols, rows, axes=axes)
-        pdf[pdf < 0] = np.min(pdf[pdf > 0])
+        pdf = self.density([bandwidth], spacing, threshold)[bandwidth]
         pdf -= pdf.min()
 
         # Normalize the PDF to compare across maps.
@@ -93,7 +87,7 @@ class HeatMap:
         plt.ion()
         fig, ax = plt.subplots(1, 1)
         # fig.set_size_inches(width / 220, height / 220)
-        ax.imshow(self.map_image)
+        ax.imshow(self.load_map_image(), extent=(0, self.width, self.height, 0))
         cb = ax.contourf(axes[0], axes[1], pdf, 15, cmap=mycmap, antialiased=True)
         fig.subplots_adjust(bottom=0)
         fig.subplots_adjust(top=1)
@@ -0,0 +1,82 @@
+"""Persist CNN scans of images so repeated scans are read from disk.
+
+A scan is identified by the image, a hash of the model weights and the scan
+parameters (grid size, jitter, tile size, ...). Probabilities are stored as
+float16, positions as float32, in one small .npz file per scan, grouped in a
+directory per model so results of retired models are easy to drop.
+"""
+from config import ARGOS_ROOT
+
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+
+
+INFERENCE_CACHE_LOCATION = f"{ARGOS_ROOT}/cache/inference"
+
+
+def scan_key(image_id, weights_hash, params):
+    """Digest identifying one scan of one image with one model."""
+    key = {"image_id": image_id, "weights": weights_hash, "params": params}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class InferenceCache:
+    """On-disk store of (positions, probabilities) per image scan."""
+
+    def __init__(self, location=INFERENCE_CACHE_LOCATION):
+        """Point the cache at a directory (created when first written)."""
+        self.location = location
+        self.stats = {"hits": 0, "misses": 0}
+
+    def path(self, image_id, weights_hash, params):
+        """Where the scan is (or would be) stored."""
+        digest = scan_key(image_id, weights_hash, params)
+        return f"{self.location}/{weights_hash[:16]}/{digest}.npz"
+
+    def get(self, image_id, weights_hash, params):
+        """Return the cached scan as a dict, or None."""
+        path = self.path(image_id, weights_hash, params)
+        if not os.path.exists(path):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        with np.load(path) as data:
+            return {
+                "positions": data["positions"],
+                "prob": data["prob"].astype(np.float32),
+            }
+
+    def put(self, image_id, weights_hash, params, positions, prob):
+        """Store a scan (atomically, so an interrupted run leaves no partial file)."""
+        path = self.path(image_id, weights_hash, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                positions=np.asarray(positions, dtype=np.float32),
+                prob=np.asarray(prob, dtype=np.float16),
+            )
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, image_id, weights_hash, params, scan):
+        """Return the cached scan, or run scan() -> (positions, prob) and cache it."""
+        cached = self.get(image_id, weights_hash, params)
+        if cached is not None:
+            return cached
+        positions, prob = scan()
+        self.put(image_id, weights_hash, params, positions, prob)
+        return {
+            "positions": np.asarray(positions, dtype=np.float32),
+            "prob": np.asarray(prob, dtype=np.float16).astype(np.float32),
+        }
+
+    def clear(self, weights_hash=None):
+        """Drop the scans of one model (or of all models)."""
+        if weights_hash is None:
+            shutil.rmtree(self.location, ignore_errors=True)
+        else:
+            shutil.rmtree(f"{self.location}/{weights_hash[:16]}", ignore_errors=True)
@@ -1,23 +1,24 @@
 """Utilities for ingesting ground truth and annotation target information."""
-from config import *
-from database import *
-from utils import *
-
-import fiona
+from config import TARGET_FILE, TRUTH_FILES
+from database import db, document_location
+from geo_utils import extract_info
+from previews import generate_previews
+from utils import (
+    fix_image_filenames,
+    map_summaries,
+    parse_image_id,
+    prepend_argos_root,
+)
+
+from glob import glob
 import numpy as np
-import pandas as pd
 import re
-import seaborn as sns
+from tqdm import tqdm
 
 
 # Define regular expression for extracting species code.
 REG_EXP = r"(\w+)\s.*"
 
-# Define some nice, random colors.
-np.random.seed(0)
-colors = list(sns.xkcd_rgb.keys())
-np.random.shuffle(colors)
-
 
 def extract_image_number(path_to_image):
     """Grab the image number from the image name."""
@@ -30,6 +31,8 @@ def extract_image_number(path_to_image):
 
 def extract_ground_truth(shape_file="truth/CZM_UAV_WAYPOINTS_2018.shp"):
     """Extract information from the shape files."""
+    import fiona
+
     shapes = fiona.open(shape_file)
     shapes = list(shapes)
     truths = []
@@ -54,8 +57,17 @@ if __name__ == "__main__":
     ingest_ground_truth = False
     ingest_maps = False
     ingest_images = True
+    generate_image_previews = True  # thumbnail/screen/full JPEGs for annotators
 
     if ingest_ground_truth:
+        import pandas as pd
+        import seaborn as sns
+
+        # Define some nice, random colors.
+        np.random.seed(0)
+        colors = list(sns.xkcd_rgb.keys())
+        np.random.shuffle(colors)
+
         # Ingest all available annotation targets.
         targets_excel = pd.read_excel(f"{TARGET_FILE}")
         scientific_names = np.unique(list(targets_excel["Scientific Name"]))
@@ -179,6 +191,8 @@ if __name__ == "__main__":
 
         # Wipe database and insert the ground truth.
         ground_truth_collection.delete_many({})
+        for truth in ground_truths:
+            truth["location"] = document_location(truth)
         ground_truth_collection.insert_many(ground_truths)
 
     if ingest_maps:
@@ -225,6 +239,12 @@ if __name__ == "__main__":
                         "site": image_info["site"],
                         "path_to_image": image_info["path_to_image"],
                         "path_to_map": image_info["path_to_map"],
+                        "exif_info": info,  # spares an exiftool call per request
                     }
                     # Insert this image object into the database.
-                    db.imagery.insert_one(image_obj)
+                    db.insert_image(image_obj)
+                if generate_image_previews:
+                    generate_previews(image_info)
+
+            # Link each image to its north/south/east/west neighbours.
+            db.build_image_neighbors(cmap["map_id"])
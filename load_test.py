@@ -0,0 +1,245 @@
+"""Load test the API with concurrent simulated annotators.
+
+Seed a scratch MongoDB database with a synthetic flight, serve the API from
+it, and replay annotation sessions from N concurrent clients:
+
+    > python load_test.py --seed
+    > ARGOS_DATABASE=ARGOS_LOADTEST python api.py
+    > python load_test.py --annotators 16 --steps 50
+
+(--spawn-server starts and stops the API automatically.) Latency percentiles
+are reported per route.
+"""
+from config import MONGO_URI
+from geo_utils import DIRECTIONS, directional_neighbors, geo_point
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import numpy as np
+import os
+from pymongo import MongoClient
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+LOADTEST_DATABASE = "ARGOS_LOADTEST"
+NB_CODES = 20
+
+
+def synthetic_exif(lat, lon):
+    """EXIF information of a nadir DJI frame at 66 ft."""
+    return {
+        "field_of_view": 94.0,
+        "camera_yaw": 0.0,
+        "relative_altitude": 20.1,
+        "img_lat": lat,
+        "img_lon": lon,
+        "img_width": 4000,
+        "img_height": 3000,
+        "date_time": "2018:08:03 10:00:00",
+    }
+
+
+def seed_database(database_name=LOADTEST_DATABASE, nb_maps=2, grid=30, nb_truths=3000):
+    """Fill a scratch database with synthetic maps, images, targets and truths."""
+    client = MongoClient(MONGO_URI)
+    sdb = client[database_name]
+    for name in ["maps", "imagery", "ground_truth", "targets", "annotations", "tiles"]:
+        sdb[name].delete_many({})
+    np.random.seed(0)
+    targets = [
+        {
+            "scientific_name": f"Species {k:02d}",
+            "codes": [f"SP{k:02d}"],
+            "common_name": f"Species {k:02d}",
+            "physiognomy": "Forb",
+            "category": "Native",
+            "color_code": "#0cb577",
+        }
+        for k in range(NB_CODES)
+    ]
+    sdb.targets.insert_many(targets)
+    spacing = 0.00025  # degrees between frames, roughly 25 m
+    start = datetime(2018, 8, 3, 10)
+    for m in range(nb_maps):
+        map_id = f"2018-08-03-loadtest_site_{m}-66"
+        path_to_site = f"2018/08/03/loadtest_site_{m}/66"
+        lat0, lon0 = 43.70 + 0.1 * m, -83.50
+        lat, lon = np.meshgrid(
+            lat0 + spacing * np.arange(grid), lon0 + spacing * np.arange(grid)
+        )
+        lat, lon = lat.ravel(), lon.ravel()
+        bounds = {
+            "north": lat.max() + spacing,
+            "south": lat.min() - spacing,
+            "east": lon.max() + spacing,
+            "west": lon.min() - spacing,
+        }
+        neighbors = directional_neighbors(lat, lon)
+        image_ids = [f"{map_id}-IMG_{k + 1:04d}" for k in range(len(lat))]
+        images = []
+        for k, image_id in enumerate(image_ids):
+            images.append(
+                {
+                    "map_id": map_id,
+                    "image_id": image_id,
+                    "lat": lat[k],
+                    "lon": lon[k],
+                    "location": geo_point(lat[k], lon[k]),
+                    "height": 3000,
+                    "width": 4000,
+                    "path_to_image": f"{path_to_site}/images/DJI_{k + 1:04d}.JPG",
+                    "exif_info": synthetic_exif(lat[k], lon[k]),
+                    "neighbors": {
+                        d: image_ids[neighbors[d][k]] if neighbors[d][k] >= 0 else None
+                        for d in DIRECTIONS
+                    },
+                }
+            )
+        sdb.imagery.insert_many(images)
+        sdb.maps.insert_one(
+            {
+                "map_id": map_id,
+                "start": f"2018:08:03 1{m}:00:00",
+                "path_to_geomap": f"{path_to_site}/maps/map.tif",
+                "path_to_images": f"{path_to_site}/images",
+                "map_boundaries": bounds,
+                "small_map_boundaries": bounds,
+            }
+        )
+        truth_lat = np.random.uniform(bounds["south"], bounds["north"], nb_truths)
+        truth_lon = np.random.uniform(bounds["west"], bounds["east"], nb_truths)
+        sdb.ground_truth.insert_many(
+            [
+                {
+                    "latlon": [truth_lat[k], truth_lon[k]],
+                    "location": geo_point(truth_lat[k], truth_lon[k]),
+                    "code": f"SP{np.random.randint(NB_CODES):02d}",
+                    "symbol": "",
+                    "type": "field_collection",
+                    "datetime": (start + timedelta(hours=m, seconds=k)).isoformat(),
+                }
+                for k in range(nb_truths)
+            ]
+        )
+    print(f"> Seeded {database_name} with {nb_maps} maps of {grid * grid} images.")
+
+
+def timed_request(base_url, method, path, data=None):
+    """Issue one request; return (status, seconds, parsed JSON or None)."""
+    body = json.dumps(data).encode() if data is not None else None
+    request = Request(f"{base_url}{path}", data=body, method=method)
+    request.add_header("Content-Type", "application/json")
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=120) as response:
+            payload = response.read()
+            status = response.status
+    except HTTPError as error:
+        payload, status = b"", error.code
+    elapsed = time.perf_counter() - start
+    try:
+        return status, elapsed, json.loads(payload)
+    except ValueError:
+        return status, elapsed, None
+
+
+def annotator_session(base_url, map_id, start_image_id, nb_steps, seed):
+    """Browse a map like an annotator would; return [(route, status, seconds)]."""
+    rng = np.random.RandomState(seed)
+    timings = []
+
+    def call(route, method, path, data=None):
+        status, elapsed, payload = timed_request(base_url, method, path, data)
+        timings.append((route, status, elapsed))
+        return status, payload
+
+    call("GET /maps", "GET", "/maps")
+    call("GET /maps/<id>", "GET", f"/maps/{map_id}")
+    call("GET /images/<id>", "GET", f"/images/{start_image_id}")
+    image_id = start_image_id
+    for step in range(nb_steps):
+        direction = DIRECTIONS[rng.randint(4)]
+        path = f"/images/navigate/{image_id}?direction={direction}"
+        status, payload = call("GET /images/navigate", "GET", path)
+        if status == 200:
+            image_id = payload["image"]["image_id"]
+        if rng.rand() < 0.3:  # drop an annotation now and then
+            annotation = {
+                "annotation_id": f"{image_id}-{seed}-{step}",
+                "image_id": image_id,
+                "scientific_name": "Species 00",
+                "alpha": rng.rand(),
+                "beta": rng.rand(),
+            }
+            call("POST /annotations", "POST", "/annotations", annotation)
+    return timings
+
+
+def report(timings, elapsed):
+    """Print p50/p99 latency per route and overall throughput."""
+    routes = sorted(set(route for route, _, _ in timings))
+    print(f"{'route':<24}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for route in routes + ["ALL"]:
+        rows = [t for t in timings if route in (t[0], "ALL")]
+        seconds = np.array([t[2] for t in rows]) * 1000
+        errors = sum(1 for t in rows if t[1] >= 500)
+        p50, p99 = np.percentile(seconds, [50, 99])
+        print(f"{route:<24}{len(rows):>8}{errors:>8}{p50:>10.1f}{p99:>10.1f}")
+    rate = len(timings) / elapsed
+    print(f"> {len(timings)} requests in {elapsed:.1f} s ({rate:.1f} req/s)")
+
+
+def wait_for_server(base_url, timeout=120):
+    """Block until the API answers (or give up)."""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            urlopen(f"{base_url}/maps", timeout=5).read()
+            return
+        except (URLError, ConnectionError):
+            time.sleep(0.5)
+    raise RuntimeError("API server did not come up.")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test the ARGOS API.")
+    parser.add_argument("--url", default="http://localhost:2005", type=str)
+    parser.add_argument("--annotators", default=8, type=int)
+    parser.add_argument("--steps", default=40, type=int)
+    parser.add_argument("--seed", action="store_true", help="Seed the scratch DB.")
+    parser.add_argument(
+        "--spawn-server",
+        action="store_true",
+        help="Start api.py against the scratch database for the duration.",
+    )
+    args = parser.parse_args()
+
+    if args.seed:
+        seed_database()
+    server = None
+    if args.spawn_server:
+        env = dict(os.environ, ARGOS_DATABASE=LOADTEST_DATABASE)
+        server = subprocess.Popen([sys.executable, "api.py"], env=env)
+    try:
+        wait_for_server(args.url)
+        maps = timed_request(args.url, "GET", "/maps")[2]
+        sessions = []
+        for k in range(args.annotators):
+            map_id = maps[k % len(maps)]["map_id"]
+            start_image_id = f"{map_id}-IMG_{1 + (37 * k) % 400:04d}"
+            sessions.append((args.url, map_id, start_image_id, args.steps, k))
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.annotators) as pool:
+            results = list(pool.map(lambda s: annotator_session(*s), sessions))
+        elapsed = time.time() - start
+        report([t for timings in results for t in timings], elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
@@ -1,11 +1,13 @@
-from config import *
-from database import *
-from cnn import *
-from models import *
-from mcmc import *
+from cnn import CNN, fill_grid, image_seed
+from database import db
+from detection_store import DetectionStore, map_positions
+from inference_cache import InferenceCache
+from models import ImageModel, MapModel
+from mosaic import ProbabilityMosaic
 import utils
+from utils import image_location_to_id, prepend_argos_root
 
-import scipy.spatial as spatial
+from glob import glob
 
 
 if __name__ == "__main__":
@@ -26,6 +28,15 @@ if __name__ == "__main__":
         (8, "Hydrocharis morsus-ranae"),  # Negwegon
     ]
 
+    # Scan parameters; a change of these (or of the model) means a fresh scan.
+    scan_params = {"nb_alpha": 40, "nb_beta": 40, "jitter": 0.01}
+    # "grid" evaluates every node; "adaptive" refines a coarse grid where needed;
+    # "sampled" lets MCMC chains spend a budget of evaluations where prob is high.
+    scan_mode = "grid"
+    adaptive_params = {"coarse_step": 8, "threshold": 0.5, "disagreement": 0.25}
+    sampling_params = {"budget": 400, "nb_chains": 32, "floor": 0.01}
+    inference_cache = InferenceCache()
+
     for map_number, scientific_name in map_queue:
 
         my_map = maps[map_number]
@@ -36,58 +47,68 @@ if __name__ == "__main__":
         # scientific_name = "Frangula alnus"
         # scientific_name = 'Rhamnus cathartica'
         cnn = CNN(scientific_name, do_load_model=True)
+        weights_hash = cnn.weights_hash()
+        params = dict(scan_params, tile_size=cnn.tile_size, seed="image_id")
+        scan_image, scan_kwargs = cnn.scan_image, dict(scan_params)
+        if scan_mode == "adaptive":
+            scan_image = cnn.scan_image_adaptive
+            scan_kwargs.update(adaptive_params)
+            params.update(adaptive_params, mode="adaptive")
+        elif scan_mode == "sampled":
+            scan_image = cnn.scan_image_sampled
+            scan_kwargs = dict(sampling_params)
+            params.update(sampling_params, mode="sampled")
+        nb_grid = scan_params["nb_alpha"] * scan_params["nb_beta"]
+        evaluations = []  # CNN evaluations per image (scanned now or cached)
 
         # Find images.
         path_to_images = f"{prepend_argos_root(my_map['path_to_images'])}/*.JPG"
         images = glob(path_to_images)
-        v = Vessel(f"{my_map['map_id']}_{cnn.model_name}.dat")
-        if "images" not in v.keys:
-            v.images = {}
+        store = DetectionStore(map_id, cnn.model_name)
+        mosaic = ProbabilityMosaic(
+            map_id, cnn.model_name, boundaries=my_map["map_boundaries"]
+        )
 
         images = sorted(images)
-        offset = 0  # in case we need to restart; default should be zero
-        for itr, path_to_image in enumerate(images[offset:]):
-            print(
-                f"> Processing {scientific_name} in image {itr+1+offset:04d} of {len(images):04d} for map {map_id}"
-            )
+        for itr, path_to_image in enumerate(images):
             path_to_image = utils.fix_path_to_image(
                 path_to_image
             )  # for a few problem images
             image_id = image_location_to_id(path_to_image)
+            if image_id in store and image_id in mosaic.images:
+                continue  # already scanned in an earlier (interrupted) run
+            print(
+                f"> Processing {scientific_name} in image {itr+1:04d} of {len(images):04d} for map {map_id}"
+            )
             image_dict = db.get_image(image_id)
             image_model = ImageModel(image_dict)
 
-            # CNN set the image
-            cnn.set_image(path_to_image)
-            pdf = cnn.predict
-
-            # Scan image.
-            alpha = np.linspace(0, 1, 40)
-            beta = np.linspace(0, 1, 40)
-            image_alpha_beta = []
-            target_probability = []
-            map_alpha_beta = []
-            for a in tqdm(alpha):
-                for b in beta:
-                    p = cnn.predict(
-                        [a + 0.010 * np.random.randn(), b + 0.010 * np.random.randn()]
-                    )
-                    target_probability.append(p)
-                    image_alpha_beta.append([a, b])
-                    lat_lon = image_model.to_lat_lon(a, b)
-                    map_alpha_beta.append(
-                        map_model.to_alpha_beta(
-                            *lat_lon, boundaries_to_use="map_boundaries"
-                        )
-                    )
-            # Package up the results.
-            v.images[image_id] = {
-                "prob": target_probability,
-                "X": image_alpha_beta,
-                "image_id": image_id,
-                "map_id": map_id,
-                "map_alpha_beta": map_alpha_beta,
-            }
-            if np.mod(itr, 25) == 0:
-                v.save()
-        v.save()
+            # Scan image (or read the scan from the inference cache).
+            scan = inference_cache.get_or_compute(
+                image_id,
+                weights_hash,
+                params,
+                lambda: scan_image(
+                    path_to_image, seed=image_seed(image_id), **scan_kwargs
+                ),
+            )
+            evaluations.append(len(scan["prob"]))
+            if scan_mode != "grid":
+                saved = 1 - evaluations[-1] / nb_grid
+                print(
+                    f"> {evaluations[-1]} of {nb_grid} evaluations, {saved:.0%} saved."
+                )
+            map_alpha_beta = map_positions(scan["positions"], image_model, map_model)
+            store.append(image_id, scan["prob"], scan["positions"], map_alpha_beta)
+            nb_alpha, nb_beta = scan_params["nb_alpha"], scan_params["nb_beta"]
+            prob_grid = fill_grid(scan["positions"], scan["prob"], nb_alpha, nb_beta)
+            mosaic.add(image_id, prob_grid, image_model)
+        print(f"> {len(store)} detections in {store.path}.")
+        if evaluations:
+            saved = 1 - sum(evaluations) / (nb_grid * len(evaluations))
+            print(
+                f"> {sum(evaluations)} evaluations in {len(evaluations)} images, "
+                f"{saved:.0%} saved."
+            )
+        print(f"> Mosaic covers {mosaic.coverage():.1%} of the map.")
+        print(f"> Inference cache: {inference_cache.stats}")
@@ -0,0 +1,163 @@
+"""Build multi-resolution (overview) pyramids for the georeferenced maps."""
+from concurrency import offload
+from database import db
+from geo_utils import lat_lon_to_tile, tile_row_latitudes, tile_to_lat_lon_bounds
+from utils import prepend_argos_root
+
+from imageio import imwrite
+import numpy as np
+import os
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from tqdm import tqdm
+
+
+BLOCK_SIZE = 512  # internal tile size of the pyramid, in pixels
+
+
+def pyramid_location(map_dict):
+    """Relative path of the pyramid that sits alongside map.tif."""
+    return map_dict["path_to_geomap"].replace("map.tif", "map_pyramid.tif")
+
+
+def overview_factors(height, width, block_size=BLOCK_SIZE):
+    """Power-of-two decimation factors, down to a single block."""
+    factors = []
+    factor = 2
+    while max(height, width) / factor >= block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors or [2]
+
+
+def build_map_pyramid(map_dict, block_size=BLOCK_SIZE, compress="deflate"):
+    """Write a tiled, compressed copy of map.tif with power-of-two overviews."""
+    path_to_geomap = prepend_argos_root(map_dict["path_to_geomap"])
+    path_to_pyramid = prepend_argos_root(pyramid_location(map_dict))
+    with rasterio.open(path_to_geomap) as src:
+        profile = src.profile.copy()
+        profile.update(
+            driver="GTiff",
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            compress=compress,
+            predictor=2,
+            BIGTIFF="IF_SAFER",
+        )
+        with rasterio.open(path_to_pyramid, "w", **profile) as dst:
+            # Copy one strip of blocks at a time; the full map never sits in memory.
+            for row in tqdm(range(0, src.height, block_size)):
+                window = Window(0, row, src.width, min(block_size, src.height - row))
+                dst.write(src.read(window=window), window=window)
+            factors = overview_factors(src.height, src.width, block_size)
+            dst.build_overviews(factors, Resampling.average)
+            dst.update_tags(ns="rio_overview", resampling="average")
+    return pyramid_location(map_dict)
+
+
+def read_map_window(
+    path_to_raster, row_start, row_stop, col_start, col_stop, out_shape
+):
+    """Read a pixel window at a reduced resolution; areas off the map are zero."""
+    out_rows, out_cols = out_shape
+    with rasterio.open(path_to_raster) as src:
+        image = np.zeros((src.count, out_rows, out_cols), dtype=src.dtypes[0])
+        # Clip the requested window to the raster itself.
+        r0, r1 = max(row_start, 0), min(row_stop, src.height)
+        c0, c1 = max(col_start, 0), min(col_stop, src.width)
+        if r1 <= r0 or c1 <= c0:
+            return np.moveaxis(image, 0, -1)
+        # Where does the clipped window land in the output array?
+        row_scale = out_rows / (row_stop - row_start)
+        col_scale = out_cols / (col_stop - col_start)
+        o_r0 = int(round((r0 - row_start) * row_scale))
+        o_r1 = max(int(round((r1 - row_start) * row_scale)), o_r0 + 1)
+        o_c0 = int(round((c0 - col_start) * col_scale))
+        o_c1 = max(int(round((c1 - col_start) * col_scale)), o_c0 + 1)
+        # A decimated read lets GDAL pull blocks from the closest overview.
+        image[:, o_r0:o_r1, o_c0:o_c1] = src.read(
+            window=Window(c0, r0, c1 - c0, r1 - r0),
+            out_shape=(src.count, o_r1 - o_r0, o_c1 - o_c0),
+            resampling=Resampling.average,
+        )
+    return np.moveaxis(image, 0, -1)
+
+
+def render_map_tile(map_model, z, x, y, tile_size=256):
+    """Render a web-mercator tile (RGBA) of the map; None if it misses the map."""
+    north, south, west, east = tile_to_lat_lon_bounds(z, x, y)
+    bnd = map_model.map_boundaries
+    if (
+        south > bnd["north"]
+        or north < bnd["south"]
+        or west > bnd["east"]
+        or east < bnd["west"]
+    ):
+        return None
+    # Read with rows linear in latitude, then resample rows onto mercator rows.
+    window = map_model.read_window(
+        north, south, west, east, out_shape=(tile_size, tile_size)
+    )
+    latitudes = tile_row_latitudes(z, y, tile_size)
+    rows = ((north - latitudes) / (north - south) * tile_size).astype(int)
+    window = window[np.clip(rows, 0, tile_size - 1)]
+    if window.shape[-1] == 4:  # map already carries an alpha band
+        return window[:, :, :4]
+    alpha = 255 * (window[:, :, :3].sum(axis=-1) > 0)
+    return np.dstack((window[:, :, :3], alpha)).astype(np.uint8)
+
+
+def render_map_tile_png(map_model, z, x, y, tile_size=256):
+    """Render a web-mercator tile and encode it as PNG bytes."""
+    tile = render_map_tile(map_model, z, x, y, tile_size)
+    if tile is None:
+        return None
+    return imwrite("<bytes>", tile, format="png")
+
+
+def seed_tile_cache(map_model, tile_cache, min_zoom=14, max_zoom=20, status=None):
+    """Render every tile covering the map into the cache (skipping cached ones)."""
+    status = status if status is not None else {}
+    jobs = []
+    for z in range(min_zoom, max_zoom + 1):
+        xs, ys = map_tile_range(map_model, z)
+        jobs.extend([(z, x, y) for x in xs for y in ys])
+    status.update({"nb_tiles": len(jobs), "nb_rendered": 0, "nb_cached": 0})
+    for z, x, y in jobs:
+        if os.path.exists(tile_cache.path(map_model.map_id, z, x, y)):
+            status["nb_cached"] += 1
+            continue
+        data = offload(render_map_tile_png, map_model, z, x, y)
+        if data is not None:
+            tile_cache.put(map_model.map_id, z, x, y, data)
+        status["nb_rendered"] += 1
+    status["complete"] = True
+    return status
+
+
+def map_tile_range(map_model, z):
+    """Return the x and y tile ranges that cover the map at zoom level z."""
+    bnd = map_model.map_boundaries
+    x0, y0 = lat_lon_to_tile(bnd["north"], bnd["west"], z)
+    x1, y1 = lat_lon_to_tile(bnd["south"], bnd["east"], z)
+    return range(x0, x1 + 1), range(y0, y1 + 1)
+
+
+def raster_shape(path_to_raster):
+    """Return (height, width, bands) of a raster from its header alone."""
+    with rasterio.open(path_to_raster) as src:
+        return src.height, src.width, src.count
+
+
+if __name__ == "__main__":
+
+    # Build pyramids for every map that does not yet have one.
+    maps = db.get_maps(return_id=True)
+    for map_dict in maps:
+        if "path_to_pyramid" in map_dict:
+            continue
+        print(f"> Building pyramid for map {map_dict['map_id']}")
+        map_dict["path_to_pyramid"] = build_map_pyramid(map_dict)
+        db.update_map(map_dict)
@@ -1,67 +1,43 @@
-from database import *
-from models import *
-from vessel import *
+from database import db
+from detection_store import DetectionStore, map_positions
+from models import ImageModel, MapModel
+from utils import prepend_argos_root
+from vessel import Vessel
 
-from ipdb import set_trace as debug
 from pylab import imshow, imread, ion, close
-from tqdm import tqdm
 
 
-def process_map(path_to_map_classification):
-    """Convert classifications to the map coordinate system."""
+def process_map(path_to_map_classification, map_id, model_name):
+    """Convert classifications to the map coordinate system, in a DetectionStore."""
     v = Vessel(path_to_map_classification)
-    keys = list(v.images.keys())
-    map_id = image_dict["map_id"]
-    map_dict = db.get_map(map_id)
-    map_model = MapModel(map_dict)
-    for key in tqdm(keys):
-        image_dict = db.get_image(v.images[key]["image_id"])
-        image_model = ImageModel(image_dict)
-        X = v.images[key]["X"]
-        P = v.images[key]["prob"]
-        map_alpha_beta = []
-        for x in X:
-            lat_lon = image_model.to_lat_lon(*x)
-            # Use the large map boundaries!
-            map_alpha_beta.append(
-                map_model.to_alpha_beta(*lat_lon, boundaries_to_use="map_boundaries")
-            )
-    v.map_alpha_beta = map_alpha_beta
-    v.save()
+    map_model = MapModel(db.get_map(map_id))
+
+    def project(image_dict):
+        image_model = ImageModel(db.get_image(image_dict["image_id"]))
+        # Use the large map boundaries!
+        return map_positions(image_dict["X"], image_model, map_model)
+
+    store = DetectionStore(map_id, model_name).import_vessel(v, project=project)
     print("> Map processed.")
+    return store
 
 
 if __name__ == "__main__":
-    path_to_annotations = (
-        "maps/2018-08-03-st_johns_marsh-66_phragmites_australis_subsp_australis.dat"
-    )
-    v = Vessel(path_to_annotations)
-    keys = list(v.images.keys())
-    key = keys[314]
-    image_dict = db.get_image(v.images[key]["image_id"])
-    map_id = image_dict["map_id"]
-    map_dict = db.get_map(map_id)
-    map_model = MapModel(map_dict)
-    X = v.images[key]["X"]
-    P = v.images[key]["prob"]
+    map_id = "2018-08-03-st_johns_marsh-66"
+    model_name = "phragmites_australis_subsp_australis"
+    store = DetectionStore(map_id, model_name)
+    if len(store) == 0:
+        process_map(f"maps/{map_id}_{model_name}.dat", map_id, model_name)
+        store.load_index()
+    image_id = store.image_ids[314]
+    image_dict = db.get_image(image_id)
+    detections = store.image(image_id)
+    X, P = detections["image_ab"], detections["prob"]
     path_to_image = prepend_argos_root(image_dict["path_to_image"])
     image = imread(path_to_image)
 
-    for key in tqdm(keys):
-        image_dict = db.get_image(v.images[key]["image_id"])
-        image_model = ImageModel(image_dict)
-        X = v.images[key]["X"]
-        P = v.images[key]["prob"]
-        map_alpha_beta = []
-        for p, x in zip(P, X):
-            lat_lon = image_model.to_lat_lon(*x)
-            # Use the large map boundaries!
-            if p>0.99:
-                map_alpha_beta.append(
-                    map_model.to_alpha_beta(*lat_lon, boundaries_to_use="map_boundaries")
-                )
-    v.map_alpha_beta = map_alpha_beta
-    v.save()
+    map_alpha_beta = store.select(0.99)["map_ab"]
+    print(f"> {len(map_alpha_beta)} of {len(store)} detections above 0.99.")
 
     # ion()
     # close("all")
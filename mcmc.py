@@ -1,12 +1,20 @@
+"""Metropolis-Hastings sampling of densities over the unit square.
+
+mcmc() runs one chain; sample_chains() advances many chains at once, calling
+a batch density pdf(positions) -> densities once per step for all chains.
+"""
 import numpy as np
 from scipy.stats import multivariate_normal
-import pylab as plt
+import time
 from tqdm import tqdm
 
 
+TARGET_ACCEPTANCE = 0.234  # optimal acceptance rate of random-walk proposals
+
+
 def in_box(pos):
-    """Determine if position is within bounds."""
-    x, y = pos
+    """Determine if position (or each row of an array of them) is within bounds."""
+    x, y = np.asarray(pos).T
     return (x >= 0) * (x < 1) * (y >= 0) * (y <= 1)
 
 
@@ -21,9 +29,13 @@ def transition(position, mean_radius=0.15):
     return next_position
 
 
+# Example target: a mixture of two Gaussians (built once, not per call).
+rv1 = multivariate_normal([0.6, 0.650], [[0.0950, 0.023], [0.0300, 0.0600]])
+rv2 = multivariate_normal([0.400, 0.250], [[0.0150, 0.023], [0.023, 0.060]])
+
+
 def pdf(position):
-    rv1 = multivariate_normal([0.6, .650], [[.0950, .023], [.0300, .0600]])
-    rv2 = multivariate_normal([.400, .250], [[.0150, .023], [.023, .060]])
+    """Example density; accepts one position or an (n, 2) array of them."""
     return rv1.pdf(position) + rv2.pdf(position)
 
 
@@ -32,34 +44,145 @@ def mcmc(pdf, nb_iter=1500):
     X = []
     P = []
     x = np.array([1 * np.random.rand(), 1 * np.random.rand()])
+    px = pdf(x)
     X.append(x)
-    P.append(pdf(x))
+    P.append(px)
     for itr in tqdm(range(nb_iter)):
-        px = pdf(x)
         x_ = transition(x)
         px_ = pdf(x_)
         r = px_ / px
         if r > 1 or (np.random.rand() < r):
-            x = x_
+            x, px = x_, px_  # keep the density of the current point
             if itr > 0.30 * nb_iter:
                 X.append(x)
                 P.append(px_)
     return X, P
 
 
+def sample_chains(
+    pdf,
+    nb_chains=64,
+    nb_iter=1500,
+    burn_in=0.3,
+    thin=1,
+    scale=0.15,
+    adapt=True,
+    start=None,
+    seed=None,
+):
+    """Run many Metropolis-Hastings chains at once over the unit square.
+
+    pdf maps an (n, 2) array of positions to n densities; it is called once
+    per step, for the in-bounds proposals only. The first burn_in fraction of
+    the steps is discarded; during it, each chain's proposal scale adapts
+    towards TARGET_ACCEPTANCE (it is fixed afterwards). Every thin-th step is
+    kept. Returns (samples, densities, stats), samples being (kept, chains, 2).
+    """
+    rng = np.random.RandomState(seed)
+    if start is None:
+        start = rng.rand(nb_chains, 2)
+    x = np.array(start, dtype=np.float64)
+    nb_chains = len(x)
+    px = np.asarray(pdf(x), dtype=np.float64).reshape(nb_chains)
+    nb_evaluations = nb_chains
+    log_scale = np.full(nb_chains, np.log(scale))
+    nb_burn_in = int(burn_in * nb_iter)
+    accepted = np.zeros(nb_chains)
+    samples, densities = [], []
+    for itr in range(nb_iter):
+        # Same proposal as transition(): uniform direction, uniform radius.
+        angle = rng.uniform(0, 2 * np.pi, nb_chains)
+        radius = np.exp(log_scale) * rng.rand(nb_chains)
+        x_ = x + radius[:, None] * np.column_stack([np.cos(angle), np.sin(angle)])
+        px_ = np.zeros(nb_chains)
+        inside = in_box(x_).astype(bool)
+        if inside.any():
+            px_[inside] = pdf(x_[inside])
+            nb_evaluations += int(inside.sum())
+        accept = inside & (rng.rand(nb_chains) * px < px_)
+        x[accept], px[accept] = x_[accept], px_[accept]
+        if itr < nb_burn_in:
+            if adapt:
+                log_scale += (accept - TARGET_ACCEPTANCE) / np.sqrt(itr + 1)
+        else:
+            accepted += accept
+            if (itr - nb_burn_in) % thin == 0:
+                samples.append(x.copy())
+                densities.append(px.copy())
+    nb_kept_steps = max(nb_iter - nb_burn_in, 1)
+    stats = {
+        "acceptance": float(accepted.mean() / nb_kept_steps),
+        "scale": np.exp(log_scale),
+        "nb_evaluations": nb_evaluations,
+    }
+    return np.array(samples).reshape(-1, nb_chains, 2), np.array(densities), stats
+
+
+def autocorrelation(x):
+    """Normalized autocorrelation of each column of x (computed with FFTs)."""
+    n = len(x)
+    x = x - x.mean(axis=0)
+    spectrum = np.fft.rfft(x, n=2 * n, axis=0)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), axis=0)[:n]
+    return acf / np.maximum(acf[:1], 1e-300)
+
+
+def effective_sample_size(samples):
+    """Effective number of independent samples in (steps, chains, dims) samples.
+
+    The autocorrelation is averaged over chains and summed in pairs until a
+    pair turns negative (Geyer's initial positive sequence); the smallest ESS
+    over the dimensions is returned.
+    """
+    nb_steps, nb_chains, nb_dims = samples.shape
+    ess = []
+    for d in range(nb_dims):
+        rho = autocorrelation(samples[:, :, d]).mean(axis=1)
+        tau = -1.0
+        for k in range(0, nb_steps - 1, 2):
+            pair = rho[k] + rho[k + 1]
+            if pair < 0:
+                break
+            tau += 2 * pair
+        ess.append(nb_steps * nb_chains / max(tau, 1.0))
+    return min(ess)
+
+
+def benchmark(nb_iter=1500, nb_chains=64, nb_single_chains=5):
+    """Effective samples per second of single chains vs. vectorized chains."""
+    start = time.time()
+    single = [np.array(mcmc(pdf, nb_iter)[0]) for _ in range(nb_single_chains)]
+    single_time = time.time() - start
+    single_ess = sum(effective_sample_size(x[:, None, :]) for x in single)
+
+    start = time.time()
+    samples, _, stats = sample_chains(pdf, nb_chains, nb_iter, seed=0)
+    vector_time = time.time() - start
+    vector_ess = effective_sample_size(samples)
+    return {
+        "single": {"ess": single_ess, "seconds": single_time},
+        "vectorized": {"ess": vector_ess, "seconds": vector_time, **stats},
+    }
+
+
 if __name__ == "__main__":
+    import pylab as plt
 
-    # Set up the parameters.
-    max_x = 1
-    max_y = 1
-    X = []
-    for k in range(5):
-        X.extend(mcmc(pdf))
-    X = np.array(X)
+    # Compare effective samples per second.
+    results = benchmark()
+    for name, result in results.items():
+        ess_per_second = result["ess"] / result["seconds"]
+        print(
+            f"> {name}: ESS {result['ess']:.0f} in {result['seconds']:.2f} s "
+            f"({ess_per_second:.0f} per second)"
+        )
 
+    # Plot some of the samples.
+    samples, _, stats = sample_chains(pdf, nb_chains=16, seed=0)
+    print(f"> Acceptance rate {stats['acceptance']:.2f}")
+    X = samples.reshape(-1, 2)
     plt.ion()
     plt.close("all")
-    plt.plot(X[:, 0], X[:, 1], alpha=0.2)
-    plt.plot(X[:, 0], X[:, 1], ".")
+    plt.plot(X[:, 0], X[:, 1], ".", alpha=0.2)
     plt.xlim([0, 1])
     plt.ylim([0, 1])
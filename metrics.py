@@ -0,0 +1,304 @@
+"""Per-request timing of pipeline stages, exposed in Prometheus text format.
+
+Each request gets a record; code running on behalf of the request reports
+time spent in named stages (MongoDB round trips, BallTree queries, exiftool
+calls, ground truth projection, ...) through timer()/timed(). When the request
+ends the per-stage totals are added to histograms labelled by route.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+import os
+import sys
+import threading
+import time
+
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_local = threading.local()  # green-thread local once eventlet has patched threading
+
+
+class Histogram:
+    """Cumulative histogram of observations (Prometheus semantics)."""
+
+    def __init__(self):
+        """Start with empty buckets."""
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation."""
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Hold the request and stage histograms for the whole process."""
+
+    def __init__(self):
+        """Create empty histogram tables."""
+        self.lock = threading.Lock()
+        self.requests = defaultdict(Histogram)  # (route, method, status)
+        self.stages = defaultdict(Histogram)  # (route, stage)
+        self.stage_calls = defaultdict(int)  # (route, stage)
+
+    def record(self, route, method, status, duration, stages):
+        """Fold one finished request into the histograms."""
+        with self.lock:
+            self.requests[(route, method, str(status))].observe(duration)
+            for stage, (seconds, calls) in stages.items():
+                self.stages[(route, stage)].observe(seconds)
+                self.stage_calls[(route, stage)] += calls
+
+    def exposition(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            lines.extend(
+                render_histogram(
+                    "argos_request_duration_seconds",
+                    "Wall time of API requests.",
+                    self.requests,
+                    ("route", "method", "status"),
+                )
+            )
+            lines.extend(
+                render_histogram(
+                    "argos_stage_duration_seconds",
+                    "Time spent per request in each pipeline stage.",
+                    self.stages,
+                    ("route", "stage"),
+                )
+            )
+            lines.append("# HELP argos_stage_calls_total Calls made to each stage.")
+            lines.append("# TYPE argos_stage_calls_total counter")
+            for key, calls in sorted(self.stage_calls.items()):
+                labels = format_labels(("route", "stage"), key)
+                lines.append(f"argos_stage_calls_total{{{labels}}} {calls}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(names, values, extra=""):
+    """Format a Prometheus label set."""
+    labels = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return ",".join(labels)
+
+
+def render_histogram(name, description, histograms, label_names):
+    """Render a family of histograms."""
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for key, hist in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, hist.counts):
+            labels = format_labels(label_names, key, f'le="{bound}"')
+            lines.append(f"{name}_bucket{{{labels}}} {count}")
+        labels = format_labels(label_names, key, 'le="+Inf"')
+        lines.append(f"{name}_bucket{{{labels}}} {hist.count}")
+        labels = format_labels(label_names, key)
+        lines.append(f"{name}_sum{{{labels}}} {hist.total:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {hist.count}")
+    return lines
+
+
+registry = Registry()
+
+
+def current():
+    """Return the record of the request being handled (or None)."""
+    return getattr(_local, "record", None)
+
+
+def bind(record):
+    """Attach a request record to the current (e.g., native worker) thread."""
+    _local.record = record
+
+
+def carry(func):
+    """Wrap func so it runs under the current request's record in any thread."""
+    record = current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        bind(record)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bind(None)
+
+    return wrapper
+
+
+def start_request():
+    """Begin timing a request."""
+    record = {"start": time.time(), "stages": defaultdict(lambda: [0.0, 0])}
+    bind(record)
+    return record
+
+
+def finish_request(route, method, status):
+    """Stop timing the current request; record it and return its duration."""
+    record = current()
+    if record is None:
+        return None
+    bind(None)
+    duration = time.time() - record["start"]
+    stages = {stage: tuple(v) for stage, v in record["stages"].items()}
+    registry.record(route, method, status, duration, stages)
+    profiler.check(route, record["start"], duration)
+    return duration
+
+
+def add_stage_time(stage, seconds, record=None):
+    """Charge time to a stage of the current request."""
+    record = record or current()
+    if record is None:  # not inside a request (scripts, background jobs)
+        return
+    record["stages"][stage][0] += seconds
+    record["stages"][stage][1] += 1
+
+
+@contextmanager
+def timer(stage):
+    """Time the enclosed block as the given stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """Decorator: time each call of the function as the given stage."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MongoTimer:
+    """pymongo command listener charging each round trip to the "mongo" stage."""
+
+    def started(self, event):
+        """Nothing to do; the duration is reported when the command ends."""
+        pass
+
+    def succeeded(self, event):
+        """Charge a completed command to the current request."""
+        add_stage_time("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        """Charge a failed command too (it still cost a round trip)."""
+        add_stage_time("mongo", event.duration_micros / 1e6)
+
+
+def native_threading():
+    """The unpatched threading module (so the sampler is a real OS thread)."""
+    try:
+        from eventlet import patcher
+
+        if patcher.is_monkey_patched("thread"):
+            return patcher.original("threading")
+    except ImportError:
+        pass
+    return threading
+
+
+class SamplingProfiler:
+    """Sample the server's stacks; dump the samples behind slow requests.
+
+    While enabled, a native thread records the stack of every other thread
+    each interval. When a request takes longer than the threshold, the
+    samples taken during it are folded into "frame;frame;frame count" lines
+    (the flame graph input format) and kept in memory and on disk.
+
+    The profile is process-wide: sys._current_frames() only sees OS threads,
+    and under eventlet every green thread runs on the same one, so a slow
+    request's profile also holds whatever other requests (and the tpool
+    threads) were doing while it was open. It shows where the process spent
+    that time, not where the one request did.
+    """
+
+    def __init__(self, location="profiles", keep=20):
+        """Start disabled."""
+        self.location = location
+        self.enabled = False
+        self.threshold = 1.0  # seconds
+        self.interval = 0.005
+        self.samples = deque(maxlen=200000)
+        self.slow_requests = deque(maxlen=keep)
+        self.thread = None
+
+    def configure(self, enabled=None, threshold_ms=None, interval_ms=None):
+        """Toggle the profiler and/or change its settings."""
+        if threshold_ms is not None:
+            self.threshold = threshold_ms / 1000
+        if interval_ms is not None:
+            self.interval = interval_ms / 1000
+        if enabled is not None:
+            self.enabled = enabled
+            if enabled and (self.thread is None or not self.thread.is_alive()):
+                self.thread = native_threading().Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return self.settings()
+
+    def settings(self):
+        """Current profiler settings."""
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold * 1000,
+            "interval_ms": self.interval * 1000,
+        }
+
+    def run(self):
+        """Sampler loop (native thread)."""
+        me = native_threading().get_ident()
+        while self.enabled:
+            now = time.time()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = os.path.basename(code.co_filename)
+                    stack.append(f"{name}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                self.samples.append((now, ";".join(reversed(stack))))
+            time.sleep(self.interval)
+
+    def check(self, route, start, duration):
+        """Keep the samples of a request if it was slow."""
+        if not self.enabled or duration < self.threshold:
+            return
+        folded = defaultdict(int)
+        for timestamp, stack in list(self.samples):
+            if start <= timestamp <= start + duration:
+                folded[stack] += 1
+        lines = [f"{stack} {count}" for stack, count in folded.items()]
+        summary = {
+            "route": route,
+            "start": start,
+            "duration": duration,
+            "scope": "process",  # samples of every thread, see the class docstring
+        }
+        self.slow_requests.append(dict(summary, folded=lines))
+        os.makedirs(self.location, exist_ok=True)
+        name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "")
+        with open(f"{self.location}/{start:.3f}-{name or 'root'}.folded", "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,109 @@
+"""Load species CNNs on first use and keep the most recently used in memory.
+
+Models are looked up by scientific name (models saved by CNN) or by numeric
+species code (the cnn_XX.h5 models of the NeuralBank). A model whose .h5 file
+has changed on disk since it was loaded (e.g., by a training run) is reloaded
+on its next use.
+"""
+from config import MODEL_LOCATION
+
+from collections import OrderedDict, defaultdict
+import os
+import threading
+import time
+
+
+MAX_MODELS = int(os.environ.get("ARGOS_MAX_MODELS", 4))  # compiled models kept
+
+
+def model_name(scientific_name):
+    """File-friendly model name for a species."""
+    return scientific_name.replace(" ", "_").lower()
+
+
+def model_location(key):
+    """Path to the .h5 file for a scientific name or a numeric species code."""
+    if isinstance(key, int):
+        return f"{MODEL_LOCATION}/cnn_{key:02d}.h5"
+    return f"{MODEL_LOCATION}/{model_name(key)}.h5"
+
+
+class ModelRegistry:
+    """LRU of loaded Keras models, reloaded when their files change."""
+
+    def __init__(self, max_models=MAX_MODELS):
+        """Nothing is loaded until a model is asked for."""
+        self.max_models = max_models
+        self.models = OrderedDict()  # key -> {"model", "mtime"}
+        self.lock = threading.Lock()
+        self.loading = defaultdict(threading.Lock)  # one load per key at a time
+        self.load_times = defaultdict(list)  # key -> seconds per load
+        self.stats = {"hits": 0, "loads": 0, "reloads": 0, "evictions": 0}
+
+    def has(self, key):
+        """Is there a saved model for key?"""
+        return os.path.exists(model_location(key))
+
+    def cached(self, key, mtime):
+        """Return the in-memory model if it is current, else None."""
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is None or entry["mtime"] != mtime:
+                return None
+            self.models.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry["model"]
+
+    def get(self, key):
+        """Return the model for key, loading (or reloading) it if needed."""
+        path = model_location(key)
+        mtime = os.path.getmtime(path)  # FileNotFoundError if never trained
+        model = self.cached(key, mtime)
+        if model is not None:
+            return model
+        with self.loading[key]:
+            model = self.cached(key, mtime)  # loaded while we waited?
+            if model is not None:
+                return model
+            from keras.models import load_model  # Keras is slow to import
+
+            start = time.time()
+            model = load_model(path)
+            elapsed = time.time() - start
+            print(f"> Loaded model {key} in {elapsed:.1f} s.")
+            self.load_times[key].append(elapsed)
+            with self.lock:
+                self.stats["reloads" if key in self.models else "loads"] += 1
+            self.register(key, model, mtime)
+        return model
+
+    def register(self, key, model, mtime=None):
+        """Keep a model that was just built or saved (current as of mtime)."""
+        if mtime is None:
+            mtime = os.path.getmtime(model_location(key))
+        with self.lock:
+            self.models[key] = {"model": model, "mtime": mtime}
+            self.models.move_to_end(key)
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def summary(self):
+        """Counters, models in memory, and load times per model."""
+        with self.lock:
+            return {
+                **self.stats,
+                "in_memory": list(self.models),
+                "load_seconds": {
+                    str(key): {
+                        "count": len(times),
+                        "mean": sum(times) / len(times),
+                        "last": times[-1],
+                    }
+                    for key, times in self.load_times.items()
+                },
+            }
+
+
+# The registry shared by everything in this process.
+registry = ModelRegistry()
@@ -1,16 +1,39 @@
 """Implements classes for import models: tiles, maps, etc."""
-from database import *
-from geo_utils import *
-
+from concurrency import offload
+from database import db
+from geo_utils import (
+    DIRECTIONS,
+    alpha_beta_to_lat_lon,
+    extract_info,
+    lat_lon_to_alpha_beta,
+)
+from metrics import timed, timer
+from utils import prepend_argos_root
+
+from datetime import datetime
 import numpy as np
 
+__all__ = [
+    "ImageModel",
+    "MapModel",
+    "TileModel",
+    "create_machine_truth",
+    "machine_truth_on_tile",
+    "project_truths",
+]
+
 
 def create_machine_truth(truth):
     """Create a new ground truth annotation."""
+    tile_dict = db.get_tile(truth["image_id"])
+    return machine_truth_on_tile(truth, tile_dict)
+
+
+def machine_truth_on_tile(truth, tile_dict):
+    """Build the ground truth object for a point annotated on the given tile."""
     alpha = truth["alpha"]
     beta = truth["beta"]
     tile_id = truth["image_id"]
-    tile_dict = db.get_tile(tile_id)
     tile_model = TileModel(tile_dict)
 
     # Extract geomapping information.
@@ -52,6 +75,23 @@ def find_unique_truth(nearby_truth_list):
     return unique_targets
 
 
+def project_truths(ordered_truths, targets, to_alpha_beta, in_bounds):
+    """Map truths (closest first) to alpha/beta, stopping at the first one outside."""
+    nearby_truths = []
+    for truth in ordered_truths:
+        lat, lon = truth["latlon"]
+        alpha, beta = to_alpha_beta(lat, lon)
+        if not in_bounds(alpha, beta):
+            break
+        truth = match_truth_to_target(truth, targets)
+        if truth is not None:
+            truth["alpha"] = alpha  # fraction of image height (rows)
+            truth["beta"] = beta  # fraction of image width (cols)
+            nearby_truths.append(truth)
+    unique_truths = find_unique_truth(nearby_truths)
+    return nearby_truths, unique_truths
+
+
 class MapModel:
     """Handles maps, including all necessary georeferencing, ground truth discovery, etc."""
 
@@ -113,27 +153,27 @@ class MapModel:
         """Determine whether specified point is in the map, or not."""
         return (alpha >= 0) * (alpha <= 1) * (beta >= 0) * (beta <= 1)
 
+    def footprint(self):
+        """Return the (north, south, west, east) extent used for ground truth."""
+        north, south = self.get_latitude_boundaries()
+        east, west = self.get_longitude_boundaries()
+        return north, south, west, east
+
+    @timed("find_ground_truth")
     def find_ground_truth(self):
         """Find ground truth present on the map and map it to alpha/beta values."""
         lat, lon = self.to_lat_lon(0.5, 0.5)  # lat/lon of map center
-        _, ordered_truth = db.truth_tree.query([[lat, lon]], k=300)
-        ordered_truth = ordered_truth[0]
-        truths = db.get_ground_truths()
+        ordered_truths = db.truths_near(lat, lon, limit=300)
         targets = db.get_targets()
-        nearby_truths = []
-        for truth_idx in ordered_truth:
-            truth = truths[truth_idx]
-            lat, lon = truth["latlon"]
-            alpha, beta = self.to_alpha_beta(lat, lon)
-            if not self.in_map(alpha, beta):
-                break
-            truth = match_truth_to_target(truth, targets)
-            if truth is not None:
-                truth["alpha"] = alpha  # fraction of image height (rows)
-                truth["beta"] = beta  # fraction of image width (cols)
-                nearby_truths.append(truth)
-        unique_truths = find_unique_truth(nearby_truths)
-        return nearby_truths, unique_truths
+        # The projection loop is CPU-bound; keep it off the green-thread hub.
+        with timer("projection"):
+            return offload(
+                project_truths,
+                ordered_truths,
+                targets,
+                self.to_alpha_beta,
+                self.in_map,
+            )
 
     def package(self):
         """Return a JSON package for transport to the client."""
@@ -143,29 +183,61 @@ class MapModel:
         package["truth"] = {"nearby": nearby_truth, "unique": unique_truth}
         return package
 
+    @property
+    def path_to_raster(self):
+        """Absolute path to the map pyramid (or to map.tif if none is built)."""
+        if "path_to_pyramid" in self.__dict__:
+            return prepend_argos_root(self.path_to_pyramid)
+        return prepend_argos_root(self.path_to_geomap)
+
+    def geomap_shape(self):
+        """Return (height, width, bands) of the georeferenced map."""
+        from map_pyramid import raster_shape  # rasterio is only needed here
+
+        return raster_shape(self.path_to_raster)
+
+    def read_window(self, north, south, west, east, max_size=1024, out_shape=None):
+        """Read the given lat/lon window of the map, touching only needed blocks.
+
+        The output is at most max_size pixels on its longest side (or exactly
+        out_shape, if given); parts of the window outside the map are zero.
+        """
+        from map_pyramid import read_map_window
+
+        height, width, _ = self.geomap_shape()
+        alpha_n, beta_w = self.to_alpha_beta(
+            north, west, boundaries_to_use="map_boundaries"
+        )
+        alpha_s, beta_e = self.to_alpha_beta(
+            south, east, boundaries_to_use="map_boundaries"
+        )
+        row_start = int(np.floor(alpha_n * height))
+        row_stop = max(int(np.ceil(alpha_s * height)), row_start + 1)
+        col_start = int(np.floor(beta_w * width))
+        col_stop = max(int(np.ceil(beta_e * width)), col_start + 1)
+        if out_shape is None:
+            rows, cols = row_stop - row_start, col_stop - col_start
+            scale = min(1, max_size / max(rows, cols))
+            out_shape = (max(round(rows * scale), 1), max(round(cols * scale), 1))
+        return read_map_window(
+            self.path_to_raster, row_start, row_stop, col_start, col_stop, out_shape
+        )
+
+    @timed("find_nearest_image")
     def find_nearest_image(self, alpha, beta, nb_tiles=1000):
         """Return the ImageModel of the tile nearest given alpha/beta coordinates."""
         lat, lon = self.to_lat_lon(alpha, beta)
-        all_images = db.get_images()
-        _, nearest_images = db.image_tree.query([[lat, lon]], k=nb_tiles)
-        nearest_images = nearest_images[0]
-        for image_idx in nearest_images:
-            image = all_images[image_idx]
-            i = ImageModel(image)
-            if i.map_id == self.map_id:
-                return i
+        images = db.images_near(lat, lon, self.map_id, limit=nb_tiles)
+        if len(images) > 0:
+            return ImageModel(images[0])
 
+    @timed("find_nearest_tile")
     def find_nearest_tile(self, alpha, beta, nb_tiles=100):
         """Return TileModel of tile nearest given alpha/beta coordinates."""
         lat, lon = self.to_lat_lon(alpha, beta)
-        all_tiles = db.get_tiles()
-        _, nearest_tiles = db.tile_tree.query([[lat, lon]], k=nb_tiles)
-        nearest_tiles = nearest_tiles[0]
-        for tile_idx in nearest_tiles:
-            tile = all_tiles[tile_idx]
-            t = TileModel(tile)
-            if t.map_id == self.map_id:  # ensure that tile is from current map
-                return t
+        tiles = db.tiles_near(lat, lon, self.map_id, limit=nb_tiles)
+        if len(tiles) > 0:  # nearest tile from the current map
+            return TileModel(tiles[0])
 
 
 class TileModel:
@@ -216,27 +288,25 @@ class TileModel:
         """Determine whether specified point is in the map, or not."""
         return (alpha >= 0) * (alpha <= 1) * (beta >= 0) * (beta <= 1)
 
+    def footprint(self):
+        """Return the (north, south, west, east) extent of the tile."""
+        return self.north, self.south, self.west, self.east
+
+    @timed("find_ground_truth")
     def find_ground_truth(self):
         """Find ground truth present on the map and map it to alpha/beta values."""
         lat, lon = self.to_lat_lon(0.5, 0.5)  # lat/lon of map center
-        _, ordered_truth = db.truth_tree.query([[lat, lon]], k=300)
-        ordered_truth = ordered_truth[0]
-        truths = db.get_ground_truths()
+        ordered_truths = db.truths_near(lat, lon, limit=300)
         targets = db.get_targets()
-        nearby_truths = []
-        for truth_idx in ordered_truth:
-            truth = truths[truth_idx]
-            lat, lon = truth["latlon"]
-            alpha, beta = self.to_alpha_beta(lat, lon)
-            if not self.in_tile(alpha, beta):
-                break
-            truth = match_truth_to_target(truth, targets)
-            if truth is not None:
-                truth["alpha"] = alpha  # fraction of image height (rows)
-                truth["beta"] = beta  # fraction of image width (cols)
-                nearby_truths.append(truth)
-        unique_truths = find_unique_truth(nearby_truths)
-        return nearby_truths, unique_truths
+        # The projection loop is CPU-bound; keep it off the green-thread hub.
+        with timer("projection"):
+            return offload(
+                project_truths,
+                ordered_truths,
+                targets,
+                self.to_alpha_beta,
+                self.in_tile,
+            )
 
     def package(self):
         """Return JSON-serialiable package for client consumption."""
@@ -249,8 +319,6 @@ class TileModel:
 
     def get_neighbor(self, direction):
         """Get the neighboring tile in the specified direction."""
-        map_id = self.map_id
-        tiles = db.get_tiles()
         if direction == "north":
             alpha = -0.5
             beta = 0.5
@@ -264,12 +332,9 @@ class TileModel:
             alpha = 0.5
             beta = 1.5
         lat, lon = self.to_lat_lon(alpha, beta)
-        _, ordered_truth = db.tile_tree.query([[lat, lon]], k=100)
-        ordered_truth = ordered_truth[0]
-        for idx in ordered_truth:
-            tile = TileModel(tiles[idx])
-            if tile.map_id == map_id:
-                return tile
+        tiles = db.tiles_near(lat, lon, self.map_id, limit=100)
+        if len(tiles) > 0:
+            return TileModel(tiles[0])
 
 
 class ImageModel:
@@ -280,7 +345,9 @@ class ImageModel:
         self.image_dict = image_dict
         for key, val in image_dict.items():
             self.__dict__[key] = val
-        self.exif_info = extract_info(prepend_argos_root(self.path_to_image))
+        if "exif_info" not in image_dict:  # stored at ingest for newer images
+            path_to_image = prepend_argos_root(self.path_to_image)
+            self.exif_info = offload(extract_info, path_to_image)
 
     def to_lat_lon(self, alpha, beta):
         """Convert image unit coordinates to lat/lon."""
@@ -298,27 +365,28 @@ class ImageModel:
         """Determine whether specified point is in the map, or not."""
         return (alpha >= 0) * (alpha <= 1) * (beta >= 0) * (beta <= 1)
 
+    def footprint(self):
+        """Return the (north, south, west, east) box around the (rotated) image."""
+        corners = [self.to_lat_lon(a, b) for a, b in [(0, 0), (0, 1), (1, 0), (1, 1)]]
+        lats = [lat for lat, _ in corners]
+        lons = [lon for _, lon in corners]
+        return max(lats), min(lats), min(lons), max(lons)
+
+    @timed("find_ground_truth")
     def find_ground_truth(self):
         """Find ground truth present on the map and map it to alpha/beta values."""
         lat, lon = self.to_lat_lon(0.5, 0.5)  # lat/lon of map center
-        _, ordered_truth = db.truth_tree.query([[lat, lon]], k=300)
-        ordered_truth = ordered_truth[0]
-        truths = db.get_ground_truths()
+        ordered_truths = db.truths_near(lat, lon, limit=300)
         targets = db.get_targets()
-        nearby_truths = []
-        for truth_idx in ordered_truth:
-            truth = truths[truth_idx]
-            lat, lon = truth["latlon"]
-            alpha, beta = self.to_alpha_beta(lat, lon)
-            if not self.in_image(alpha, beta):
-                break
-            truth = match_truth_to_target(truth, targets)
-            if truth is not None:
-                truth["alpha"] = alpha  # fraction of image height (rows)
-                truth["beta"] = beta  # fraction of image width (cols)
-                nearby_truths.append(truth)
-        unique_truths = find_unique_truth(nearby_truths)
-        return nearby_truths, unique_truths
+        # The projection loop is CPU-bound; keep it off the green-thread hub.
+        with timer("projection"):
+            return offload(
+                project_truths,
+                ordered_truths,
+                targets,
+                self.to_alpha_beta,
+                self.in_image,
+            )
 
     def package(self):
         """Return JSON-serialiable package for client consumption."""
@@ -329,16 +397,16 @@ class ImageModel:
         return package
 
     def get_neighbor(self, direction):
-        """Get the neighboring tile in the specified direction."""
-        map_id = self.map_id
-        image_list = db.get_images()
-        _, nearest_images = db.image_tree.query([[self.lat, self.lon]], k=2000)
-        for idx in nearest_images[0]:
-            image = image_list[idx]
-            # Looking for another image within this map.
-            this_map = map_id == image["map_id"]
-            if not this_map:
-                continue
+        """Get the neighboring image in the specified direction."""
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Direction must be one of {', '.join(DIRECTIONS)}.")
+        if "neighbors" in self.image_dict:  # precomputed at ingest
+            neighbor_id = self.neighbors[direction]
+            if neighbor_id is None:
+                return None
+            return ImageModel(db.get_image(neighbor_id))
+        # Nearby images within this map, closest first.
+        for image in db.images_near(self.lat, self.lon, self.map_id, limit=2000):
             direction_satisfied = False
             # Check to see if new image is shifted appropriately to this one.
             if direction == "north":
@@ -0,0 +1,160 @@
+"""Map-aligned probability raster, built up image by image while a map is scanned.
+
+Each scanned image adds its probability grid to every mosaic cell it covers
+(a running sum and a count per cell), so the mean probability over the map is
+available at any time, during or after the scan, without touching the
+detections again. The rasters are .npy memmaps whose size is set by the
+resolution (longest side, in cells), not by the number of images:
+
+    python mosaic.py 2018-08-03-st_johns_marsh-66 frangula_alnus
+"""
+from config import ARGOS_ROOT
+
+import json
+import numpy as np
+import os
+import sys
+
+
+MOSAIC_LOCATION = f"{ARGOS_ROOT}/mosaics"
+MOSAIC_RESOLUTION = 4096  # cells along the longest side of the map
+
+
+def mosaic_shape(boundaries, resolution=MOSAIC_RESOLUTION):
+    """(rows, cols) of a raster over the boundaries, with roughly square cells."""
+    height = boundaries["north"] - boundaries["south"]
+    mid_latitude = (boundaries["north"] + boundaries["south"]) / 2
+    width = (boundaries["east"] - boundaries["west"]) * np.cos(np.radians(mid_latitude))
+    scale = resolution / max(height, width)
+    return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+
+class ProbabilityMosaic:
+    """Running sum and count of CNN probabilities over a map's map_boundaries."""
+
+    def __init__(
+        self,
+        map_id,
+        model_name,
+        boundaries=None,
+        resolution=MOSAIC_RESOLUTION,
+        location=MOSAIC_LOCATION,
+        mode="r+",
+    ):
+        """Open the mosaic, creating it over boundaries if it does not exist yet.
+
+        Use mode="r" to look at a mosaic that another process is writing.
+        """
+        self.path = f"{location}/{map_id}_{model_name}"
+        meta_file = f"{self.path}/meta.json"
+        if not os.path.exists(meta_file):
+            if boundaries is None or mode == "r":
+                raise FileNotFoundError(f"No mosaic at {self.path}.")
+            self.create(boundaries, mosaic_shape(boundaries, resolution))
+        with open(meta_file) as f:
+            self.meta = json.load(f)
+        self.boundaries = self.meta["boundaries"]
+        self.shape = tuple(self.meta["shape"])
+        self.images = set(self.meta["images"])
+        self.sum = np.load(f"{self.path}/sum.npy", mmap_mode=mode)
+        self.count = np.load(f"{self.path}/count.npy", mmap_mode=mode)
+
+    def create(self, boundaries, shape):
+        """Allocate zeroed rasters on disk (sparse files, so this is cheap)."""
+        os.makedirs(self.path, exist_ok=True)
+        for name, dtype in [("sum", np.float32), ("count", np.uint16)]:
+            raster = np.lib.format.open_memmap(
+                f"{self.path}/{name}.npy", mode="w+", dtype=dtype, shape=shape
+            )
+            del raster
+        self.meta = {"boundaries": boundaries, "shape": list(shape), "images": []}
+        self.save_meta()
+
+    def save_meta(self):
+        """Write the metadata atomically."""
+        meta_file = f"{self.path}/meta.json"
+        tmp_file = f"{meta_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, meta_file)
+
+    def cell_lat_lon(self, rows, cols):
+        """Latitude/longitude of the centres of the given cells."""
+        bnd, (nb_rows, nb_cols) = self.boundaries, self.shape
+        alpha, beta = (rows + 0.5) / nb_rows, (cols + 0.5) / nb_cols
+        lat = bnd["north"] * (1 - alpha) + bnd["south"] * alpha
+        lon = bnd["west"] * (1 - beta) + bnd["east"] * beta
+        return lat, lon
+
+    def lat_lon_cell(self, lat, lon):
+        """(row, col) of the cells containing the given latitudes/longitudes."""
+        bnd, (nb_rows, nb_cols) = self.boundaries, self.shape
+        alpha = (lat - bnd["north"]) / (bnd["south"] - bnd["north"])
+        beta = (lon - bnd["west"]) / (bnd["east"] - bnd["west"])
+        rows, cols = np.floor(alpha * nb_rows), np.floor(beta * nb_cols)
+        return rows.astype(int), cols.astype(int)
+
+    def add(self, image_id, prob_grid, image_model):
+        """Add an image's (nb_alpha, nb_beta) probability grid to the cells it covers.
+
+        image_model converts between the image's (alpha, beta) and lat/lon (an
+        ImageModel). Returns False if the image was added before.
+        """
+        if image_id in self.images:
+            return False
+        prob_grid = np.asarray(prob_grid, dtype=np.float32)
+        nb_alpha, nb_beta = prob_grid.shape
+
+        # Cells within the bounding box of the image footprint.
+        corners = np.array([0, 0, 1, 1]), np.array([0, 1, 0, 1])
+        rows, cols = self.lat_lon_cell(*image_model.to_lat_lon(*corners))
+        r0, r1 = max(rows.min(), 0), min(rows.max() + 1, self.shape[0])
+        c0, c1 = max(cols.min(), 0), min(cols.max() + 1, self.shape[1])
+        if r0 < r1 and c0 < c1:
+            rows, cols = np.mgrid[r0:r1, c0:c1]
+            alpha, beta = image_model.to_alpha_beta(*self.cell_lat_lon(rows, cols))
+            inside = (alpha >= 0) & (alpha <= 1) & (beta >= 0) & (beta <= 1)
+
+            # Nearest scanned grid position for every covered cell.
+            i = np.rint(alpha[inside] * (nb_alpha - 1)).astype(int)
+            j = np.rint(beta[inside] * (nb_beta - 1)).astype(int)
+            self.sum[r0:r1, c0:c1][inside] += prob_grid[i, j]
+            self.count[r0:r1, c0:c1][inside] += 1
+            self.sum.flush()
+            self.count.flush()
+        self.images.add(image_id)
+        self.meta["images"].append(image_id)
+        self.save_meta()
+        return True
+
+    def mean(self, window=None):
+        """Mean probability per cell (NaN where no image has been scanned)."""
+        window = window or (slice(None), slice(None))
+        count = self.count[window]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, self.sum[window] / count, np.nan)
+
+    def coverage(self):
+        """Fraction of the cells covered by at least one image."""
+        return float(np.count_nonzero(self.count)) / self.count.size
+
+    def save_preview(self, path, max_size=1024):
+        """Write the mean probability as a greyscale PNG (transparent if unscanned)."""
+        from PIL import Image
+
+        step = max(1, int(np.ceil(max(self.shape) / max_size)))
+        mean = self.mean((slice(None, None, step), slice(None, None, step)))
+        grey = np.nan_to_num(mean * 255).astype(np.uint8)
+        alpha = np.where(np.isnan(mean), 0, 255).astype(np.uint8)
+        Image.fromarray(np.dstack([grey, grey, grey, alpha]), "RGBA").save(path)
+
+
+if __name__ == "__main__":
+    # Look at the mosaic of a scan (which may still be running).
+    map_id, model_name = sys.argv[1:3]
+    mosaic = ProbabilityMosaic(map_id, model_name, mode="r")
+    coverage = mosaic.coverage()
+    print(f"> {len(mosaic.images)} images, {coverage:.1%} of the map covered.")
+    path = f"{map_id}_{model_name}_mosaic.png"
+    mosaic.save_preview(path)
+    print(f"> Preview written to {path}.")
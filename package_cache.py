@@ -0,0 +1,158 @@
+"""Cache of serialized map/image/tile packages, invalidated by ground truth writes."""
+from serialization import compress, dumps
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+
+
+class PackageCache:
+    """Hold serialized packages keyed by (kind, id), e.g. ("map", map_id).
+
+    Each entry remembers the lat/lon footprint it covers. The database calls
+    invalidate() with the locations of any truths that were added, deleted or
+    whose target changed, and only entries whose footprint contains one of
+    those points are dropped.
+    """
+
+    def __init__(self, max_entries=512):
+        """Create an empty cache holding at most max_entries packages."""
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0  # bumped by every invalidation
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "prefetched": 0,
+            "prefetch_hits": 0,
+            "invalidated": 0,
+        }
+
+    def __contains__(self, key):
+        """Is a package cached under key?"""
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """Return the cached entry for key (or None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, package, footprint, generation=None, prefetched=False):
+        """Serialize and store a package along with its footprint.
+
+        If a generation is given and an invalidation happened since, the
+        package may already be stale; it is returned but not cached.
+        """
+        body = dumps(package)
+        entry = {
+            "body": body,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "footprint": footprint,
+            "prefetched": prefetched,
+            "encoded": {},  # compressed bodies, made on first request
+        }
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if prefetched:
+                self.stats["prefetched"] += 1
+        return entry
+
+    def get_or_build(self, key, build):
+        """Return the cached entry, or build() -> (package, footprint) and cache it."""
+        entry = self.get(key)
+        with self.lock:
+            if entry is None:
+                self.stats["misses"] += 1
+            else:
+                self.stats["hits"] += 1
+                if entry["prefetched"]:
+                    self.stats["prefetch_hits"] += 1
+                    entry["prefetched"] = False  # count each prefetch once
+        if entry is None:
+            generation = self.generation
+            package, footprint = build()
+            entry = self.put(key, package, footprint, generation)
+        return entry
+
+    def encoded_body(self, entry, encoding):
+        """Return the entry's body compressed with encoding (computed once)."""
+        if encoding is None:
+            return entry["body"]
+        if encoding not in entry["encoded"]:
+            entry["encoded"][encoding] = compress(entry["body"], encoding)
+        return entry["encoded"][encoding]
+
+    def summary(self):
+        """Return cache counters, including hit rates."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        nb_requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / nb_requests if nb_requests else 0
+        stats["prefetch_hit_rate"] = (
+            stats["prefetch_hits"] / nb_requests if nb_requests else 0
+        )
+        return stats
+
+    def invalidate(self, latlons):
+        """Drop every entry whose footprint contains any of the given points."""
+        with self.lock:
+            self.generation += 1
+            stale = []
+            for key, entry in self.entries.items():
+                north, south, west, east = entry["footprint"]
+                for lat, lon in latlons:
+                    if south <= lat <= north and west <= lon <= east:
+                        stale.append(key)
+                        break
+            for key in stale:
+                del self.entries[key]
+            self.stats["invalidated"] += len(stale)
+        return stale
+
+    def clear(self):
+        """Drop everything."""
+        with self.lock:
+            self.entries.clear()
+
+
+class Prefetcher:
+    """Speculatively build packages on a worker pool before they are requested."""
+
+    def __init__(self, cache, nb_workers=4):
+        """Attach to a PackageCache."""
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=nb_workers)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, key, build):
+        """Queue build() -> (package, footprint) unless cached or already queued."""
+        with self.lock:
+            if key in self.pending or key in self.cache:
+                return
+            self.pending.add(key)
+        self.pool.submit(self._build, key, build)
+
+    def _build(self, key, build):
+        """Worker: build the package and cache it (marked as prefetched)."""
+        try:
+            generation = self.cache.generation
+            package, footprint = build()
+            self.cache.put(key, package, footprint, generation, prefetched=True)
+        except Exception as error:  # a failed guess must never hurt a request
+            print(f"> Prefetch of {key} failed: {error}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
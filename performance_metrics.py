@@ -1,6 +1,8 @@
-from cnn import *
-from config import *
-from generate_batch import *
+from cnn import CNN
+from config import TARGET_SPECIES
+from database import extract_tiles_from_annotation, get_specified_target
+from generate_batch import create_batch
+from model_registry import registry
 from vessel import Vessel
 
 import numpy as np
@@ -160,8 +162,9 @@ class ConfusionMatrix:
         """Classify all the tiles."""
         scores = {}
         for scientific_name in tqdm(self.target_species):
-            cnn = CNN(scientific_name, do_load_model=True)
-            scores[scientific_name] = cnn.model.predict(self.X)
+            model = registry.get(scientific_name)
+            scores[scientific_name] = model.predict(self.X)
+        print(f"> Model loads: {registry.summary()['load_seconds']}")
         self.scores = scores
         cm = Vessel("confusion_matrix.dat")
         cm.scores = scores
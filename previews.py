@@ -0,0 +1,63 @@
+"""Generate and cache downscaled JPEG previews of the raw drone images."""
+from config import ARGOS_ROOT
+from utils import prepend_argos_root
+
+import hashlib
+import os
+from PIL import Image
+import threading
+
+
+PREVIEW_LOCATION = f"{ARGOS_ROOT}/cache/previews"
+PREVIEW_LEVELS = {"thumbnail": 256, "screen": 1600, "full": None}  # longest side
+JPEG_QUALITY = 85
+
+
+def preview_path(image_id, level, root=PREVIEW_LOCATION):
+    """Location of a preview; directories are sharded by a hash of the image_id."""
+    shard = hashlib.sha1(image_id.encode()).hexdigest()
+    return f"{root}/{shard[:2]}/{shard[2:4]}/{image_id}-{level}.jpg"
+
+
+def save_preview(image, path, max_size=None):
+    """Downscale (if max_size is given) and save a progressive JPEG atomically."""
+    if max_size is not None:
+        image = image.copy()
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(tmp_path, "JPEG", quality=JPEG_QUALITY, progressive=True)
+    os.replace(tmp_path, path)
+
+
+def generate_previews(image_dict, levels=None, overwrite=False):
+    """Produce preview JPEGs of an image for the requested levels (default: all)."""
+    levels = levels or list(PREVIEW_LEVELS.keys())
+    image_id = image_dict["image_id"]
+    todo = [
+        level
+        for level in levels
+        if overwrite or not os.path.exists(preview_path(image_id, level))
+    ]
+    if len(todo) == 0:
+        return
+    # Largest level first; smaller ones are downscaled from the decoded pixels.
+    todo = sorted(todo, key=lambda level: -(PREVIEW_LEVELS[level] or float("inf")))
+    with Image.open(prepend_argos_root(image_dict["path_to_image"])) as image:
+        max_size = PREVIEW_LEVELS[todo[0]]
+        if max_size is not None:
+            # Let the JPEG decoder drop resolution (DCT scaling) before resizing.
+            image.draft("RGB", (max_size, max_size))
+        image = image.convert("RGB")
+        for level in todo:
+            save_preview(image, preview_path(image_id, level), PREVIEW_LEVELS[level])
+
+
+def get_preview(image_dict, level):
+    """Return the path to the requested preview, generating it lazily."""
+    if level not in PREVIEW_LEVELS:
+        raise ValueError(f"Unknown preview level '{level}'.")
+    path = preview_path(image_dict["image_id"], level)
+    if not os.path.exists(path):
+        generate_previews(image_dict, levels=[level])
+    return path
@@ -1,13 +1,15 @@
-from config import *
-from database import *
-from utils import *
+from database import db
+from utils import prepend_argos_root
 
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
 from glob import glob
 from imageio import imwrite
-from ipdb import set_trace as debug
 import numpy as np
-from skimage import io
+import rasterio
+from rasterio.windows import Window
+import resource
+import time
 from tqdm import tqdm
 
 
@@ -65,57 +67,135 @@ def read_associated_kml_file(path_to_tile):
     return parse_keyhole(path_to_kml)
 
 
-def split_tile(path_to_tile, tile_size=2048, tile_number=1):
-    """Split a tile into squares of dimension <tile_size>."""
+def tile_bounds(kml, height, width, tile_size=2048):
+    """Compute pixel offsets and lat/lon bounds of every sub-tile at once."""
+    ts = tile_size
+    nb_cols = int(width / ts)
+    nb_rows = int(height / ts)
+    # Sub-tiles are numbered column by column (all rows of column 0 first, etc.).
+    cols, rows = np.meshgrid(np.arange(nb_cols), np.arange(nb_rows), indexing="ij")
+    cols, rows = cols.ravel(), rows.ravel()
+    # Latitude/longitude vary linearly across the pixels of the raster.
+    lat_per_pixel = (kml["south"] - kml["north"]) / (height - 1)
+    lon_per_pixel = (kml["east"] - kml["west"]) / (width - 1)
+    return {
+        "row_offset": rows * ts,
+        "col_offset": cols * ts,
+        "north": kml["north"] + rows * ts * lat_per_pixel,
+        "south": kml["north"] + (ts * (rows + 1) - 1) * lat_per_pixel,
+        "west": kml["west"] + cols * ts * lon_per_pixel,
+        "east": kml["west"] + (ts * (cols + 1) - 1) * lon_per_pixel,
+    }
+
+
+def write_sub_tiles(path_to_tile, jobs, tile_size=2048):
+    """Read windows from the source raster and write them out as PNGs."""
+    with rasterio.open(path_to_tile) as src:
+        for row_offset, col_offset, path_to_sub_tile in jobs:
+            window = Window(col_offset, row_offset, tile_size, tile_size)
+            tile_ = src.read(window=window)  # (bands, rows, cols)
+            imwrite(path_to_sub_tile, np.moveaxis(tile_, 0, -1))
+    return len(jobs)
+
+
+def plan_sub_tiles(path_to_tile, tile_size=2048, tile_number=1):
+    """Determine tile objects and write jobs for a large tile (no pixels read)."""
     tn = tile_number
     path_list = pl = path_to_tile.split("/")
     root_path = rp = "/".join(path_list[:-1])  # absolute path
     relative_path = (
         f"{pl[-7]}/{pl[-6]}/{pl[-5]}/{pl[-4]}/{pl[-3]}/tiles"
     )  # relative path
-    tile = io.imread(path_to_tile)[:, :, :]  # only grab three color channels
-    height, width, channels = tile.shape
+    with rasterio.open(path_to_tile) as src:  # only the header is read here
+        height, width = src.height, src.width
     kml = read_associated_kml_file(path_to_tile)
-    latitudes = np.linspace(kml["north"], kml["south"], height)
-    longitudes = np.linspace(kml["west"], kml["east"], width)
-    nb_cols = int(width / tile_size)
-    nb_rows = int(height / tile_size)
-    ts = tile_size
-    itr = 0
-    for c in np.arange(nb_cols):
-        west = longitudes[c * ts]
-        east = longitudes[ts * (c + 1) - 1]
-        lon_ = (west + east) / 2
-        for r in np.arange(nb_rows):
-            itr += 1
-            # Extract sub-tile from large tile.
-            tile_ = tile[r * ts : (r + 1) * ts, c * ts : (c + 1) * ts, :]
-            north = latitudes[r * ts]
-            south = latitudes[ts * (r + 1) - 1]
-            lat_ = (north + south) / 2
-            absolute_path_to_sub_tile = f"{root_path}/TILE_{tn:04d}_{itr:04d}.png"
-            relative_path_to_sub_tile = f"{relative_path}/TILE_{tn:04d}_{itr:04d}.png"
-            tile_id = (
-                f"{pl[-7]}-{pl[-6]}-{pl[-5]}-{pl[-4]}-{pl[-3]}-TILE_{tn:04d}_{itr:04d}"
-            )
-            tile_obj = {
+    bounds = tile_bounds(kml, height, width, tile_size)
+    tile_objs = []
+    jobs = []
+    for idx in range(len(bounds["north"])):
+        itr = idx + 1
+        absolute_path_to_sub_tile = f"{root_path}/TILE_{tn:04d}_{itr:04d}.png"
+        relative_path_to_sub_tile = f"{relative_path}/TILE_{tn:04d}_{itr:04d}.png"
+        tile_id = (
+            f"{pl[-7]}-{pl[-6]}-{pl[-5]}-{pl[-4]}-{pl[-3]}-TILE_{tn:04d}_{itr:04d}"
+        )
+        tile_objs.append(
+            {
                 "tile_id": tile_id,
-                "north": north,
-                "south": south,
-                "west": west,
-                "east": east,
+                "north": float(bounds["north"][idx]),
+                "south": float(bounds["south"][idx]),
+                "west": float(bounds["west"][idx]),
+                "east": float(bounds["east"][idx]),
                 "path_to_tile": relative_path_to_sub_tile,
             }
-            imwrite(absolute_path_to_sub_tile, tile_)
-            db.insert_tile(tile_obj)
+        )
+        jobs.append(
+            (
+                int(bounds["row_offset"][idx]),
+                int(bounds["col_offset"][idx]),
+                absolute_path_to_sub_tile,
+            )
+        )
+    return tile_objs, jobs
+
+
+def submit_sub_tiles(pool, path_to_tile, jobs, tile_size=2048, jobs_per_task=8):
+    """Hand write jobs to the process pool in chunks (one raster open per chunk)."""
+    futures = []
+    for k in range(0, len(jobs), jobs_per_task):
+        futures.append(
+            pool.submit(
+                write_sub_tiles, path_to_tile, jobs[k : k + jobs_per_task], tile_size
+            )
+        )
+    return futures
+
+
+def peak_rss_in_mb():
+    """Peak resident set size of this process and its (finished) workers."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / 1024, rss_children / 1024  # ru_maxrss is in KB on Linux
+
+
+def split_tile(path_to_tile, tile_size=2048, tile_number=1, nb_workers=None):
+    """Split a tile into squares of dimension <tile_size>."""
+    tile_objs, jobs = plan_sub_tiles(path_to_tile, tile_size, tile_number)
+    with ProcessPoolExecutor(max_workers=nb_workers) as pool:
+        futures = submit_sub_tiles(pool, path_to_tile, jobs, tile_size)
+        wait(futures)
+    for future in futures:
+        future.result()  # surface any errors raised in the workers
+    db.insert_tiles(tile_objs)
+    return tile_objs
 
 
-def process_tiles(path_to_tiles, tile_size=2048):
+def process_tiles(path_to_tiles, tile_size=2048, nb_workers=None):
     """Process an entire directory of tiles. Insert them into database."""
     tiles = glob(f"{path_to_tiles}/*.tif")
     tiles = sorted(tiles)
-    for tile_number, path_to_tile in enumerate(tqdm(tiles)):
-        split_tile(path_to_tile, tile_number=tile_number)
+    start = time.time()
+    tile_objs = []
+    futures = []
+    # All large tiles share one pool, so workers never sit idle between files.
+    with ProcessPoolExecutor(max_workers=nb_workers) as pool:
+        for tile_number, path_to_tile in enumerate(tiles):
+            tile_objs_, jobs = plan_sub_tiles(path_to_tile, tile_size, tile_number)
+            tile_objs.extend(tile_objs_)
+            futures.extend(submit_sub_tiles(pool, path_to_tile, jobs, tile_size))
+        with tqdm(total=len(tile_objs)) as progress:
+            for future in as_completed(futures):
+                progress.update(future.result())
+    db.insert_tiles(tile_objs)  # one bulk insert once every PNG is on disk
+
+    # Report throughput and memory usage.
+    elapsed = time.time() - start
+    rss, rss_workers = peak_rss_in_mb()
+    print(
+        f"> Wrote {len(tile_objs)} tiles from {len(tiles)} rasters in {elapsed:.1f} s "
+        f"({len(tile_objs) / max(elapsed, 1e-9):.2f} tiles/sec)."
+    )
+    print(f"> Peak RSS: {rss:.0f} MB (main), {rss_workers:.0f} MB (largest worker).")
     return tiles
 
 
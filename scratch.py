@@ -1,6 +1,6 @@
-from database import *
-from utils import *
-from vessel import *
+from database import db
+from utils import extract_tiles, parse_image_id, prepend_argos_root
+from vessel import Vessel
 
 import numpy as np
 import pylab as plt
@@ -60,7 +60,7 @@ if __name__ == "__main__":
 
     for sample in negative_samples:
         if sample['scientific_name'] == 'Frangula alnus':
-            debug()
+            breakpoint()
     for sample in positive_samples:
         if sample['scientific_name'] != 'Frangula alnus':
-            debug()
+            breakpoint()
@@ -0,0 +1,76 @@
+"""Fast JSON serialization and response compression for the API."""
+from bson import ObjectId
+from datetime import datetime
+import gzip
+import json
+import numpy as np
+
+try:  # orjson is much faster than the standard library, when it is available
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MIN_COMPRESS_BYTES = 1024  # smaller bodies are not worth compressing
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def default(obj):
+    """Convert types that JSON encoders do not know about."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, np.generic):  # NumPy scalars (float64, int64, bool_, ...)
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Serialize obj to JSON bytes."""
+    if orjson is not None:
+        options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        return orjson.dumps(obj, default=default, option=options)
+    return json.dumps(obj, default=default).encode()
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best encoding the client accepts: br, then gzip (or None).
+
+    An encoding listed with q=0 is refused, not accepted.
+    """
+    accepted = []
+    for item in (accept_encoding or "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.append(name.lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    """Compress bytes with the given encoding ("br" or "gzip")."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
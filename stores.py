@@ -1,11 +1,20 @@
 """Loads big things into memory once, so playing around is faster."""
+from detection_store import DetectionStore
 from vessel import Vessel
 
 
+def detections(map_id, model_name):
+    """Detection store for a map scan, imported from its old .dat file if needed."""
+    store = DetectionStore(map_id, model_name)
+    if len(store) == 0:
+        store.import_vessel(Vessel(f"maps/{map_id}_{model_name}.dat"))
+    return store
+
+
 print("> Loading map positions.")
-# phrag = Vessel(
-#     "maps/2018-08-03-st_johns_marsh-66_phragmites_australis_subsp_australis.dat"
+# phrag = detections(
+#     "2018-08-03-st_johns_marsh-66", "phragmites_australis_subsp_australis"
 # )
-frangula_07 = Vessel("maps/2018-07-06-st_johns_marsh-66_frangula_alnus.dat")
-frangula_08 = Vessel("maps/2018-08-03-st_johns_marsh-66_frangula_alnus.dat")
-elberta_centaurea_06 = Vessel("maps/2018-06-27-elberta_site_1-66_centaurea_stoebe.dat")
+frangula_07 = detections("2018-07-06-st_johns_marsh-66", "frangula_alnus")
+frangula_08 = detections("2018-08-03-st_johns_marsh-66", "frangula_alnus")
+elberta_centaurea_06 = detections("2018-06-27-elberta_site_1-66", "centaurea_stoebe")
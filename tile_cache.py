@@ -0,0 +1,81 @@
+"""On-disk cache for rendered map tiles, capped in size (LRU eviction)."""
+from config import ARGOS_ROOT
+
+from glob import glob
+import os
+import threading
+
+
+TILE_CACHE_LOCATION = f"{ARGOS_ROOT}/cache/tiles"
+MAX_CACHE_BYTES = 2 * 1024 ** 3  # 2 GB
+
+
+class TileCache:
+    """Store encoded tiles as files; file access times double as LRU order."""
+
+    def __init__(self, root=TILE_CACHE_LOCATION, max_bytes=MAX_CACHE_BYTES):
+        """Point the cache at a directory; its current size is scanned lazily."""
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._nb_bytes = None
+
+    def path(self, map_id, z, x, y):
+        """Location of a cached tile."""
+        return f"{self.root}/{map_id}/{z}/{x}/{y}.png"
+
+    @property
+    def nb_bytes(self):
+        """Total size of the cache, in bytes."""
+        if self._nb_bytes is None:
+            files = glob(f"{self.root}/**/*.png", recursive=True)
+            self._nb_bytes = sum(os.path.getsize(f) for f in files)
+        return self._nb_bytes
+
+    def get(self, map_id, z, x, y):
+        """Return cached tile bytes (or None), marking the tile as recently used."""
+        path = self.path(map_id, z, x, y)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # bump to the front of the LRU order
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, map_id, z, x, y, data):
+        """Write a tile atomically, evicting old tiles if over the size cap."""
+        path = self.path(map_id, z, x, y)
+        with self.lock:
+            self.nb_bytes  # scan before writing, so the new tile is not counted twice
+        try:
+            old_size = os.path.getsize(path)  # overwriting replaces these bytes
+        except FileNotFoundError:
+            old_size = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._nb_bytes = self.nb_bytes + len(data) - old_size
+            if self._nb_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self, fraction=0.9):
+        """Delete least recently used tiles until below fraction of the cap."""
+        files = glob(f"{self.root}/**/*.png", recursive=True)
+        files = sorted(files, key=os.path.getmtime)
+        nb_bytes = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if nb_bytes <= fraction * self.max_bytes:
+                break
+            nb_bytes -= os.path.getsize(f)
+            os.remove(f)
+        self._nb_bytes = nb_bytes
+
+    def clear(self, map_id):
+        """Drop every cached tile for the given map."""
+        for f in glob(f"{self.root}/{map_id}/**/*.png", recursive=True):
+            os.remove(f)
+        self._nb_bytes = None
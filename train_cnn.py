@@ -1,6 +1,4 @@
 """Generate a batch of training data (in a separate process, usually)."""
-from database import *
-
 import argparse
 
 
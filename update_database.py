@@ -1,8 +1,9 @@
 """Utilities to help changeover to tile-based system."""
-from database import *
-from read_kml import parse_keyhole, ingest_kml_file
+from database import db
+from geo_utils import extract_info
+from read_kml import ingest_kml_file
+from utils import prepend_argos_root
 
-from ipdb import set_trace as debug
 from tqdm import tqdm
 
 
@@ -25,6 +26,20 @@ if __name__ == "__main__":
                 mp["small_map_boundaries"] = small_kml
             db.update_map(mp)
 
+    # Store EXIF information and the neighbour graph on existing images.
+    if True:
+        images = list(db.imagery.find({"exif_info": {"$exists": False}}))
+        for img in tqdm(images):
+            info = extract_info(prepend_argos_root(img["path_to_image"]))
+            db.imagery.update_one({"_id": img["_id"]}, {"$set": {"exif_info": info}})
+        for mp in db.get_maps():
+            db.build_image_neighbors(mp["map_id"])
+
+    # GeoJSON locations and 2dsphere indexes for the mongo spatial backend.
+    if True:
+        db.add_locations()
+        db.ensure_geo_indexes()
+
     # Make sure annotations have alpha/beta values.
     if True:
         annotations = db.get_annotations(return_id=True)
@@ -1,20 +1,14 @@
 """Build tiles for a one vs many CNN classifier."""
-from config import *
+from config import ARGOS_ROOT
 from geo_utils import extract_info
 from vessel import Vessel
 
-import cv2
 from datetime import datetime
 from glob import glob
-import imutils
-from ipdb import set_trace as debug
 import numpy as np
 import os
-import pylab as plt
-from skimage.io import imread
 import shutil
 import re
-from tqdm import tqdm
 
 
 def make_image_name(image_object):
@@ -89,7 +83,7 @@ def extract_tiles_from_image(
 
         # Extract tiles, if we're still here.
         if target_species < 0:
-            debug()
+            raise ValueError(f"Invalid target species code {target_species}.")
         col, row = annotation["col"], annotation["row"]
         col_, row_ = (
             col * 4000 / annotation["imageWidth"],
@@ -123,6 +117,8 @@ def extract_balanced_tiles(
     path_to_annotations, target_species, tile_size=128, tiles_per_class=2000
 ):
     """Extract equal numbers of target species tiles and tiles from randomly selected species."""
+    from skimage.io import imread
+
     print("> Extracting tiles.")
     maps = Vessel("data/label_maps.dat")
     data = Vessel(path_to_annotations)
@@ -203,8 +199,10 @@ def map_summaries():
                                     datetime_obj = datetime.strptime(
                                         start, "%Y:%m:%d %H:%M:%S"
                                     )
-                                except:
-                                    debug()
+                                except (TypeError, ValueError) as error:
+                                    raise ValueError(
+                                        f"Bad date_time '{start}' in {images[0]}."
+                                    ) from error
                                 datetime_str = datetime_obj.strftime("%d %b %Y")
                                 smalldate = datetime_obj.strftime("%Y-%m-%d")
                                 time_str = datetime_obj.strftime("%I-%M%p")
@@ -399,6 +397,7 @@ def extract_homography_from_image_object(image_obj):
 
 def extract_tiles(img, row, col, size=128, num_rotations=10, jitter_amplitude=10):
     """Extract rotated tiles from an image."""
+    import imutils
 
     images = []
 
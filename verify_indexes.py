@@ -0,0 +1,111 @@
+"""Check, via explain plans, that the hot Database queries are served by indexes.
+
+Run against a populated database (e.g., after update_database.py):
+
+    python verify_indexes.py
+
+Each query's winning plan must avoid a collection scan; queries marked
+covered must also be answered from the index alone (no documents examined).
+Deletes use the same filters as the finds listed here, so they share plans.
+
+Only the per-map image positions are covered. The other paths are checked
+for an index scan alone: annotation queries return whole documents, and
+ground truth positions are the latlon array, which an index can only hold
+as a multikey index, and multikey indexes never cover a query.
+"""
+from database import db
+
+import sys
+
+
+def plan_stages(plan):
+    """All stage names in a (possibly nested) query plan."""
+    plan = plan.get("queryPlan", plan)  # slot-based engine wraps the plan
+    stages = [plan["stage"]]
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = children + [plan["inputStage"]]
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def sample_value(collection, field):
+    """Some existing value of field (None if no document has it)."""
+    doc = collection.find_one({field: {"$exists": True}}, {field: 1})
+    return None if doc is None else doc[field]
+
+
+def hot_queries():
+    """(name, collection, filter, projection, covered) for each hot access path."""
+    image_id = sample_value(db.annotations, "image_id")
+    tile_id = sample_value(db.annotations, "tile_id")
+    scientific_name = sample_value(db.annotations, "scientific_name")
+    truth_image_id = sample_value(db.ground_truths, "image_id")
+    truth_tile_id = sample_value(db.ground_truths, "tile_id")
+    code = sample_value(db.ground_truths, "code")
+    map_id = sample_value(db.imagery, "map_id")
+    positions = {"_id": 0, "image_id": 1, "lat": 1, "lon": 1}
+    latlon = {"_id": 0, "latlon": 1}
+    queries = [
+        ("annotations_for_image", db.annotations, {"image_id": image_id}, None, False),
+        ("annotations_for_tile", db.annotations, {"tile_id": tile_id}, None, False),
+        (
+            "specified_target",
+            db.annotations,
+            {"scientific_name": scientific_name, "image_id": {"$exists": True}},
+            None,
+            False,
+        ),
+        (
+            "ground_truth_for_image",
+            db.ground_truths,
+            {"image_id": truth_image_id},
+            latlon,
+            False,
+        ),
+        (
+            "ground_truth_for_tile",
+            db.ground_truths,
+            {"tile_id": truth_tile_id},
+            latlon,
+            False,
+        ),
+        (
+            "ground_truth_for_codes",
+            db.ground_truths,
+            {"code": {"$in": [code]}},
+            latlon,
+            False,
+        ),
+        ("map_image_positions", db.imagery, {"map_id": map_id}, positions, True),
+    ]
+    # Skip access paths the database has no data for.
+    samples = {
+        "annotations_for_image": image_id,
+        "annotations_for_tile": tile_id,
+        "specified_target": scientific_name,
+        "ground_truth_for_image": truth_image_id,
+        "ground_truth_for_tile": truth_tile_id,
+        "ground_truth_for_codes": code,
+        "map_image_positions": map_id,
+    }
+    return [q for q in queries if samples[q[0]] is not None]
+
+
+def verify(name, collection, query, projection, covered):
+    """Explain the query; return True if it is served as required."""
+    explain = collection.find(query, projection).explain()
+    stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+    examined = explain["executionStats"]["totalDocsExamined"]
+    ok = "COLLSCAN" not in stages and (not covered or examined == 0)
+    status = "ok" if ok else "FAILED"
+    print(f"> {name}: {' <- '.join(stages)} ({examined} docs examined) {status}")
+    return ok
+
+
+if __name__ == "__main__":
+    db.ensure_indexes()
+    results = [verify(*query) for query in hot_queries()]
+    if not all(results):
+        sys.exit(1)
@@ -5,7 +5,7 @@ This script can run on CPU in a few minutes.
 Results example: http://i.imgur.com/4nj4KjN.jpg
 """
 from __future__ import print_function
-from cnn_bank import *
+from cnn_bank import bank
 
 import numpy as np
 import time